@@ -0,0 +1,11 @@
+# *************************************************************************** #
+#                                                                             #
+#                                                        :::      ::::::::    #
+#    __init__.py                                       :+:      :+:    :+:    #
+#                                                    +:+ +:+         +:+      #
+#    By: cmariot <cmariot@student.42.fr>           +#+  +:+       +#+         #
+#                                                +#+#+#+#+#+   +#+            #
+#    Created: 2026/10/18 10:12:41 by cmariot          #+#    #+#              #
+#    Updated: 2026/10/18 10:12:41 by cmariot         ###   ########.fr        #
+#                                                                             #
+# *************************************************************************** #
@@ -0,0 +1,435 @@
+# *************************************************************************** #
+#                                                                             #
+#                                                        :::      ::::::::    #
+#    clustering.py                                     :+:      :+:    :+:    #
+#                                                    +:+ +:+         +:+      #
+#    By: cmariot <cmariot@student.42.fr>           +#+  +:+       +#+         #
+#                                                +#+#+#+#+#+   +#+            #
+#    Created: 2026/10/18 15:31:12 by cmariot          #+#    #+#              #
+#    Updated: 2026/10/18 15:31:12 by cmariot         ###   ########.fr        #
+#                                                                             #
+# *************************************************************************** #
+
+# k-means fitting shared by ds02/ex04/elbow.py and ds02/ex05/Clustering.py,
+# either on all the customers or, to scale to large customer bases, with
+# mini-batches or on a stratified sample of the customers.
+
+import os
+import time
+import argparse
+from datetime import datetime, timezone
+import joblib
+import numpy
+import pandas
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import (
+    FunctionTransformer,
+    RobustScaler,
+    StandardScaler
+)
+
+
+METHODS = ("full", "minibatch", "sample")
+
+SCALINGS = ("none", "standard", "robust")
+
+# Default number of customers used to fit with the "sample" method.
+SAMPLE_SIZE = 100_000
+
+# Default number of customers per mini-batch with the "minibatch" method,
+# and per chunk when assigning the customers to the clusters.
+BATCH_SIZE = 4096
+
+# Maximum number of passes over the data with the "minibatch" method. Its
+# max_iter counts full passes, not the iterations of Lloyd's algorithm, so
+# the max_iter of the full KMeans (50_000 in Clustering.py) is capped to
+# it. The fit also stops after MINIBATCH_MAX_NO_IMPROVEMENT mini-batches
+# without any improvement of the inertia.
+MINIBATCH_MAX_ITER = 100
+MINIBATCH_MAX_NO_IMPROVEMENT = 10
+
+# Number of quantile bins of each feature used to stratify the sample.
+STRATA_BINS = 4
+
+# The saved models are found from the location of this file, at the root of
+# the repository, so the scripts can be run from any directory.
+MODEL_PATH = os.path.normpath(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "models",
+        "clustering.joblib"
+    )
+)
+
+# Version of the format of the saved models, increased whenever the
+# content of the saved dictionary changes.
+MODEL_FORMAT = 1
+
+
+def log_columns(values: numpy.ndarray, columns: list[int]) -> numpy.ndarray:
+    """
+    Replace the values of the columns by their log(1 + x).
+    """
+    values = numpy.array(values, dtype=numpy.float64)
+    values[:, columns] = numpy.log1p(values[:, columns])
+    return values
+
+
+def exp_columns(values: numpy.ndarray, columns: list[int]) -> numpy.ndarray:
+    """
+    Inverse of log_columns.
+    """
+    values = numpy.array(values, dtype=numpy.float64)
+    values[:, columns] = numpy.expm1(values[:, columns])
+    return values
+
+
+def make_scaler(scaling: str = "none", log: list[int] = ()):
+    """
+    Create the preprocessing of the features: log(1 + x) of the columns
+    'log', then a standard (mean and standard deviation) or robust (median
+    and interquartile range) scaling of all the columns.
+    Return None when there is nothing to do.
+    """
+    if scaling not in SCALINGS:
+        raise ValueError(f"Invalid scaling: {scaling}")
+    steps = []
+    if len(log) > 0:
+        steps.append((
+            "log",
+            FunctionTransformer(
+                func=log_columns,
+                inverse_func=exp_columns,
+                kw_args={"columns": list(log)},
+                inv_kw_args={"columns": list(log)},
+                check_inverse=False,
+            )
+        ))
+    if scaling == "standard":
+        steps.append(("scale", StandardScaler()))
+    elif scaling == "robust":
+        steps.append(("scale", RobustScaler()))
+    return Pipeline(steps) if len(steps) > 0 else None
+
+
+def preprocess(
+    data: pandas.DataFrame,
+    scaling: str = "none",
+    log: list[str] = ()
+) -> tuple:
+    """
+    Fit the preprocessing of make_scaler on the data, 'log' being the
+    names of the columns to log.
+    Return the preprocessed data, with the same index and columns, and
+    the fitted scaler, or the data itself and None without preprocessing.
+    """
+    columns = list(data.columns)
+    scaler = make_scaler(scaling, [columns.index(column) for column in log])
+    if scaler is None:
+        return data, None
+    values = scaler.fit_transform(data.to_numpy(dtype=numpy.float64))
+    return pandas.DataFrame(values, index=data.index, columns=columns), scaler
+
+
+def unscale(scaler, centroids: numpy.ndarray) -> numpy.ndarray:
+    """
+    Centroids in the units of the features before the preprocessing.
+    """
+    if scaler is None:
+        return numpy.asarray(centroids)
+    return scaler.inverse_transform(centroids)
+
+
+def make_model(
+    n_clusters: int,
+    method: str = "full",
+    max_iter: int = 300,
+    n_init: int = 10,
+    batch_size: int = BATCH_SIZE,
+    random_state: int | None = None
+):
+    """
+    Create the k-means model used by 'method': MiniBatchKMeans for
+    "minibatch", with at most MINIBATCH_MAX_ITER passes over the data,
+    KMeans otherwise.
+    """
+    if method == "minibatch":
+        return MiniBatchKMeans(
+            n_clusters=n_clusters,
+            max_iter=min(max_iter, MINIBATCH_MAX_ITER),
+            max_no_improvement=MINIBATCH_MAX_NO_IMPROVEMENT,
+            n_init=n_init,
+            batch_size=batch_size,
+            random_state=random_state,
+        )
+    return KMeans(
+        n_clusters=n_clusters,
+        max_iter=max_iter,
+        n_init=n_init,
+        random_state=random_state,
+    )
+
+
+def stratified_sample(
+    data: pandas.DataFrame,
+    size: int,
+    random_state: int | None = None
+) -> pandas.DataFrame:
+    """
+    Return about 'size' rows of the data, drawn in the same proportion
+    from each stratum, the combinations of the quantile bins of the
+    features, so the rare customers (big spenders, very frequent buyers)
+    are still represented in the sample.
+    """
+    if size >= len(data):
+        return data
+    strata = [
+        pandas.qcut(
+            data[column].rank(method="first"),
+            q=STRATA_BINS,
+            labels=False
+        )
+        for column in data.columns
+    ]
+    return data.groupby(strata, group_keys=False).sample(
+        frac=size / len(data),
+        random_state=random_state
+    )
+
+
+def fit(
+    data: pandas.DataFrame,
+    n_clusters: int,
+    method: str = "full",
+    max_iter: int = 300,
+    n_init: int = 10,
+    sample_size: int = SAMPLE_SIZE,
+    batch_size: int = BATCH_SIZE,
+    random_state: int | None = None
+) -> tuple:
+    """
+    Fit k-means with 'n_clusters' clusters on the data with 'method':
+    - "full": KMeans on all the rows,
+    - "minibatch": MiniBatchKMeans on all the rows, by mini-batches,
+    - "sample": KMeans on a stratified sample of 'sample_size' rows.
+    Return the fitted model and the time taken.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Invalid method: {method}")
+    start = time.perf_counter()
+    if method == "sample":
+        data = stratified_sample(data, sample_size, random_state)
+    model = make_model(
+        n_clusters, method, max_iter, n_init, batch_size, random_state
+    )
+    model.fit(numpy.asarray(data, dtype=numpy.float64))
+    return model, time.perf_counter() - start
+
+
+def predict(
+    model,
+    data: pandas.DataFrame,
+    batch_size: int = BATCH_SIZE * 256
+) -> numpy.ndarray:
+    """
+    Assign each row of the data to its closest cluster, by chunks of
+    'batch_size' rows so the distance matrix stays small.
+    """
+    values = numpy.asarray(data, dtype=numpy.float64)
+    if len(values) == 0:
+        return numpy.empty(0, dtype=numpy.int32)
+    return numpy.concatenate([
+        model.predict(values[start:start + batch_size])
+        for start in range(0, len(values), batch_size)
+    ])
+
+
+def nearest_centroid(
+    centroids: numpy.ndarray,
+    data: pandas.DataFrame,
+    batch_size: int = BATCH_SIZE * 256
+) -> numpy.ndarray:
+    """
+    Same as predict from the centroids only: the index of the closest
+    centroid of each row of the data.
+    """
+    values = numpy.asarray(data, dtype=numpy.float64)
+    centroids = numpy.asarray(centroids, dtype=numpy.float64)
+    labels = numpy.empty(len(values), dtype=numpy.int32)
+    for start in range(0, len(values), batch_size):
+        chunk = values[start:start + batch_size]
+        # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, |x|^2 being the same for all
+        # the centroids.
+        distances = (centroids ** 2).sum(axis=1) - 2 * chunk @ centroids.T
+        labels[start:start + batch_size] = distances.argmin(axis=1)
+    return labels
+
+
+def save_model(
+    path: str,
+    centroids: numpy.ndarray,
+    status: list[str],
+    features: list[str],
+    recency_from: str,
+    reference_date,
+    watermark,
+    scaler=None
+) -> dict:
+    """
+    Save everything needed to assign new customers to the clusters
+    without fitting again: the centroids, in the units of the scaled
+    features, the scaler of the features, the
+    status of each cluster, how the recency is computed, and the last
+    purchase of the data the model was fitted on (the watermark).
+    The saved model is tagged with the time it was created.
+    Return the saved dictionary.
+    """
+    created_at = datetime.now(timezone.utc)
+    saved = {
+        "format": MODEL_FORMAT,
+        "version": created_at.strftime("%Y%m%dT%H%M%SZ"),
+        "created_at": created_at,
+        "centroids": numpy.asarray(centroids),
+        "scaler": scaler,
+        "status": list(status),
+        "features": list(features),
+        "recency_from": recency_from,
+        "reference_date": reference_date,
+        "watermark": watermark,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    joblib.dump(saved, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+    print(f"Model {saved['version']} saved in {path}")
+    return saved
+
+
+def load_model(path: str = MODEL_PATH) -> dict:
+    """
+    Load a model saved by save_model.
+    """
+    saved = joblib.load(path)
+    if saved.get("format") != MODEL_FORMAT:
+        raise ValueError(
+            f"The model {path} has the format {saved.get('format')}, "
+            f"expected {MODEL_FORMAT}, fit it again."
+        )
+    return saved
+
+
+def score(saved: dict, features: pandas.DataFrame) -> numpy.ndarray:
+    """
+    Assign the customers to the clusters of a saved model.
+    """
+    values = features[saved["features"]].to_numpy(dtype=numpy.float64)
+    if saved["scaler"] is not None:
+        values = saved["scaler"].transform(values)
+    return nearest_centroid(saved["centroids"], values)
+
+
+def inertia(model, data: pandas.DataFrame) -> float:
+    """
+    Sum of the squared distances of all the rows of the data to their
+    closest centroid, so the models fitted on a sample or by mini-batches
+    can be compared with a full fit.
+    """
+    return -model.score(numpy.asarray(data, dtype=numpy.float64))
+
+
+def compare_with_full(
+    model,
+    elapsed: float,
+    data: pandas.DataFrame,
+    max_iter: int = 300,
+    n_init: int = 10,
+    random_state: int | None = None
+) -> tuple[float, float]:
+    """
+    Fit k-means on all the rows of the data and print its inertia and fit
+    time next to the ones of 'model'.
+    Return the inertia of both models.
+    """
+    full_model, full_elapsed = fit(
+        data,
+        model.n_clusters,
+        "full",
+        max_iter=max_iter,
+        n_init=n_init,
+        random_state=random_state
+    )
+    model_inertia = inertia(model, data)
+    full_inertia = full_model.inertia_
+    print(
+        f"k={model.n_clusters}: inertia {model_inertia:_.2f} in "
+        f"{elapsed:.3f}s, full fit {full_inertia:_.2f} in "
+        f"{full_elapsed:.3f}s "
+        f"({(model_inertia / full_inertia - 1) * 100:+.2f}%)"
+    )
+    return model_inertia, full_inertia
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Add the command line arguments selecting how k-means is fitted.
+    """
+    parser.add_argument(
+        "--method",
+        choices=METHODS,
+        default="full",
+        help="fit k-means on all the customers, by mini-batches or on a "
+             "stratified sample of the customers (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--sample-size",
+        type=int,
+        default=SAMPLE_SIZE,
+        help="number of customers in the sample with --method sample "
+             "(default: %(default)s)"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=BATCH_SIZE,
+        help="number of customers per mini-batch with --method minibatch "
+             "(default: %(default)s)"
+    )
+    parser.add_argument(
+        "--scaling",
+        choices=SCALINGS,
+        default="none",
+        help="scaling of the features before k-means (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--log-monetary",
+        action="store_true",
+        help="use log(1 + monetary) to reduce the weight of the biggest "
+             "spenders"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="seed of the random initializations and samples, to get the "
+             "same clusters from a run to another"
+    )
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="also fit k-means on all the customers and compare the "
+             "inertias"
+    )
+
+
+def check_arguments(
+    parser: argparse.ArgumentParser,
+    arguments: argparse.Namespace
+) -> None:
+    """
+    Check the values of the arguments added by add_arguments.
+    """
+    if arguments.sample_size < 1:
+        parser.error("--sample-size must be at least 1")
+    if arguments.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
@@ -0,0 +1,147 @@
+# *************************************************************************** #
+#                                                                             #
+#                                                        :::      ::::::::    #
+#    columns.py                                        :+:      :+:    :+:    #
+#                                                    +:+ +:+         +:+      #
+#    By: cmariot <cmariot@student.42.fr>           +#+  +:+       +#+         #
+#                                                +#+#+#+#+#+   +#+            #
+#    Created: 2026/10/18 18:02:51 by cmariot          #+#    #+#              #
+#    Updated: 2026/10/18 18:02:51 by cmariot         ###   ########.fr        #
+#                                                                             #
+# *************************************************************************** #
+
+# Types of the columns of the data_202*_*** tables created by the ds00
+# loaders, either the original ones or compact ones (--compact).
+
+import argparse
+
+
+# Values of the event_type column, in the order of the customer journey.
+EVENT_TYPES = ("view", "cart", "remove_from_cart", "purchase")
+
+EVENT_TYPE_ENUM = "event_type_enum"
+
+# Types of the price column with --compact: 4 bytes floats, or exact
+# prices with 2 decimals.
+PRICE_TYPES = {
+    "real": "REAL",
+    "numeric": "NUMERIC(10, 2)",
+}
+
+DEFAULT_COLUMN_TYPES = {
+    "event_type": "VARCHAR(32)",
+    "price": "FLOAT",
+    "user_session": "TEXT",
+}
+
+
+def get_column_types(
+    compact: bool = False,
+    price_type: str = "real"
+) -> dict[str, str]:
+    """
+    Return the types of the event_type, price and user_session columns.
+    With 'compact', event_type is an ENUM (4 bytes instead of up to 17),
+    price a REAL or a NUMERIC(10, 2) and user_session a UUID (16 bytes
+    instead of 37). COPY rejects the rows which do not match these types,
+    so the data is validated while it is loaded.
+    """
+    if not compact:
+        return dict(DEFAULT_COLUMN_TYPES)
+    return {
+        "event_type": EVENT_TYPE_ENUM,
+        "price": PRICE_TYPES[price_type],
+        "user_session": "UUID",
+    }
+
+
+def create_enum_query() -> str:
+    """
+    Create the ENUM type of the event_type column, if it does not exist.
+    """
+    values = ", ".join(f"'{event_type}'" for event_type in EVENT_TYPES)
+    query = (
+        f"""
+        DO $$
+        BEGIN
+            CREATE TYPE {EVENT_TYPE_ENUM} AS ENUM ({values});
+        EXCEPTION
+            WHEN duplicate_object THEN NULL;
+        END
+        $$;
+        """
+    )
+    print(query)
+    return query
+
+
+def get_table_column_types(cursor, table_name: str) -> dict[str, str]:
+    """
+    Return the types of the columns of the table 'table_name' as formatted
+    by PostgreSQL, by column name, an empty dict if it does not exist.
+    """
+    cursor.execute(
+        """
+        SELECT attname, format_type(atttypid, atttypmod)
+            FROM pg_attribute
+            WHERE attrelid = to_regclass(%s)
+            AND attnum > 0 AND NOT attisdropped
+            ORDER BY attnum;
+        """,
+        (table_name,)
+    )
+    return dict(cursor.fetchall())
+
+
+def check_column_types(
+    cursor,
+    table_name: str,
+    column_types: dict[str, str]
+) -> None:
+    """
+    Raise a ValueError if the table 'table_name' exists and its columns do
+    not have the types of 'column_types', which CREATE TABLE IF NOT EXISTS
+    would silently keep.
+    The types are compared as formatted by PostgreSQL, by creating an
+    empty temporary table with the types of 'column_types'.
+    """
+    existing_types = get_table_column_types(cursor, table_name)
+    if len(existing_types) == 0:
+        return
+    definitions = ", ".join(
+        f"{column} {column_type}"
+        for column, column_type in column_types.items()
+    )
+    cursor.execute(f"CREATE TEMP TABLE column_types_check ({definitions});")
+    expected_types = get_table_column_types(cursor, "column_types_check")
+    cursor.execute("DROP TABLE column_types_check;")
+    differences = [
+        f"{column} is {existing_types.get(column)} instead of {column_type}"
+        for column, column_type in expected_types.items()
+        if existing_types.get(column) != column_type
+    ]
+    if differences:
+        raise ValueError(
+            f"{table_name} already exists with other column types "
+            f"({', '.join(differences)}), drop it first."
+        )
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Add the command line arguments selecting the types of the columns.
+    """
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help=f"store event_type as the {EVENT_TYPE_ENUM} ENUM, price as "
+             "--price-type and user_session as UUID, the rows not matching "
+             "these types are rejected"
+    )
+    parser.add_argument(
+        "--price-type",
+        choices=sorted(PRICE_TYPES),
+        default="real",
+        help="type of the price column with --compact "
+             "(default: %(default)s)"
+    )
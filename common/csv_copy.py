@@ -0,0 +1,62 @@
+# *************************************************************************** #
+#                                                                             #
+#                                                        :::      ::::::::    #
+#    csv_copy.py                                       :+:      :+:    :+:    #
+#                                                    +:+ +:+         +:+      #
+#    By: cmariot <cmariot@student.42.fr>           +#+  +:+       +#+         #
+#                                                +#+#+#+#+#+   +#+            #
+#    Created: 2026/10/18 19:41:07 by cmariot          #+#    #+#              #
+#    Updated: 2026/10/18 19:41:07 by cmariot         ###   ########.fr        #
+#                                                                             #
+# *************************************************************************** #
+
+# Streaming of the local CSV files to the tables with COPY FROM STDIN,
+# shared by the --stdin option of the ds00 loaders.
+
+import gzip
+import psycopg2
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Size of the chunks read from the local CSV files with --stdin.
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+def open_csv(path: str):
+    """
+    Open the local CSV file 'path' in binary mode.
+    Files ending with .gz or .zst are decompressed on the fly, so they are
+    never fully held in memory.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ModuleNotFoundError(
+                "The zstandard package is needed to load .zst files."
+            )
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return open(path, "rb", buffering=COPY_BUFFER_SIZE)
+
+
+def copy_from_stdin(
+    cursor: psycopg2.extensions.cursor,
+    table_name: str,
+    path: str
+) -> int:
+    """
+    Stream the local CSV file 'path' to the table 'table_name' with
+    COPY FROM STDIN, in chunks of COPY_BUFFER_SIZE bytes.
+    Unlike COPY FROM 'path', the file does not need to be mounted in the
+    docker container.
+    Return the number of rows copied.
+    """
+    query = f"COPY {table_name} FROM STDIN CSV HEADER;"
+    print(query)
+    with open_csv(path) as file:
+        cursor.copy_expert(query, file, size=COPY_BUFFER_SIZE)
+    return cursor.rowcount
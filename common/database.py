@@ -0,0 +1,221 @@
+# *************************************************************************** #
+#                                                                             #
+#                                                        :::      ::::::::    #
+#    database.py                                       :+:      :+:    :+:    #
+#                                                    +:+ +:+         +:+      #
+#    By: cmariot <cmariot@student.42.fr>           +#+  +:+       +#+         #
+#                                                +#+#+#+#+#+   +#+            #
+#    Created: 2026/10/18 10:12:41 by cmariot          #+#    #+#              #
+#    Updated: 2026/10/18 10:12:41 by cmariot         ###   ########.fr        #
+#                                                                             #
+# *************************************************************************** #
+
+import os
+import time
+import uuid
+import threading
+import functools
+import contextlib
+from dotenv import load_dotenv
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+
+
+# The .env_postgres file is found from the location of this file, so the
+# scripts can be run from any directory.
+DOTENV_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "postgresql_docker",
+    ".env_postgres"
+)
+
+# Default maximum number of connections opened by the pool.
+POOL_MAX_CONNECTIONS = 8
+
+# Default number of rows fetched per round trip by fetch_batches.
+STREAM_ITERSIZE = 100_000
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+@functools.cache
+def load_env(dotenv_path: str = DOTENV_PATH) -> tuple:
+    """
+    Load the postgresql config from the .env_postgres file.
+    Return a tuple with the config.
+    The file is only parsed on the first call.
+    """
+    env_file_loaded = load_dotenv(dotenv_path)
+    if env_file_loaded is False:
+        raise FileNotFoundError(
+            "The .env_postgres file is missing or is empty."
+        )
+    environment_variables = (
+        os.getenv('POSTGRES_HOST'),
+        os.getenv('POSTGRES_DB'),
+        os.getenv('POSTGRES_USER'),
+        os.getenv('POSTGRES_PASSWORD'),
+        os.getenv('POSTGRES_PORT')
+    )
+    if any(variable is None for variable in environment_variables):
+        raise ValueError(
+            "One or more config variables are missing.\n" +
+            f"Please check the {dotenv_path} file."
+        )
+    return environment_variables
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """
+    Cursor printing the time taken by each query it runs.
+    """
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            print(f"Query executed in {time.perf_counter() - start:.3f}s")
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            print(f"COPY executed in {time.perf_counter() - start:.3f}s")
+
+
+def get_pool(
+    max_connections: int = POOL_MAX_CONNECTIONS
+) -> ThreadedConnectionPool:
+    """
+    Return the connection pool shared by the whole process.
+    The pool is opened on the first call, with at most 'max_connections'
+    connections, so a script running queries from several threads must
+    call it first with a large enough value.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            (host, database, username, password, port) = load_env()
+            _pool = ThreadedConnectionPool(
+                minconn=1,
+                maxconn=max_connections,
+                host=host,
+                database=database,
+                user=username,
+                password=password,
+                port=port,
+                cursor_factory=TimedCursor
+            )
+        return _pool
+
+
+def close_pool() -> None:
+    """
+    Close all the connections of the pool.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+@contextlib.contextmanager
+def get_connection():
+    """
+    Borrow a connection from the pool for the duration of the with block.
+    The transaction is rolled back if the block raises, and the
+    connection is given back to the pool afterwards, ready for the next
+    query, instead of being closed.
+    """
+    pool = get_pool()
+    connection = pool.getconn()
+    try:
+        yield connection
+    except Exception:
+        if not connection.closed:
+            connection.rollback()
+        raise
+    finally:
+        if not connection.closed and connection.autocommit:
+            connection.autocommit = False
+        pool.putconn(connection)
+
+
+def fetch_all(query: str, vars=None) -> list:
+    """
+    Run the query on a pooled connection and return all its rows.
+    """
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(query, vars)
+        data = cursor.fetchall()
+        cursor.close()
+    return data
+
+
+def get_partitions(cursor, table_name: str) -> list[str]:
+    """
+    Return the names of the partitions attached to the table 'table_name',
+    an empty list if it is not partitioned.
+    """
+    cursor.execute(
+        """
+        SELECT child.relname
+            FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relname = %s;
+        """,
+        (table_name,)
+    )
+    return [partition[0] for partition in cursor.fetchall()]
+
+
+def is_view(cursor, table_name: str) -> bool:
+    """
+    Return True if 'table_name' is a view, like the customers view on the
+    star schema of ds01/ex03/star_schema.py, instead of a table.
+    """
+    cursor.execute(
+        "SELECT relkind = 'v' FROM pg_class WHERE relname = %s;",
+        (table_name,)
+    )
+    relkind = cursor.fetchone()
+    return relkind is not None and relkind[0]
+
+
+def check_not_view(cursor, table_name: str) -> None:
+    """
+    Raise a ValueError if 'table_name' is a view, for the scripts which
+    modify the rows of the table in place.
+    """
+    if is_view(cursor, table_name):
+        raise ValueError(
+            f"{table_name} is a view on the star schema, run "
+            "ds01/ex03/star_schema.py --revert first to restore the "
+            f"{table_name} table."
+        )
+
+
+def fetch_batches(query: str, vars=None, itersize: int = STREAM_ITERSIZE):
+    """
+    Run the query with a server-side (named) cursor and yield its rows in
+    lists of at most 'itersize' rows.
+    The result stays on the server until it is fetched, so only one batch
+    is held in memory at a time instead of the whole result.
+    The pooled connection is used until the generator is exhausted or
+    closed.
+    """
+    with get_connection() as connection:
+        cursor = connection.cursor(name=f"stream_{uuid.uuid4().hex}")
+        cursor.itersize = itersize
+        cursor.execute(query, vars)
+        while batch := cursor.fetchmany(itersize):
+            yield batch
+        cursor.close()
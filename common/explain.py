@@ -0,0 +1,384 @@
+# *************************************************************************** #
+#                                                                             #
+#                                                        :::      ::::::::    #
+#    explain.py                                        :+:      :+:    :+:    #
+#                                                    +:+ +:+         +:+      #
+#    By: cmariot <cmariot@student.42.fr>           +#+  +:+       +#+         #
+#                                                +#+#+#+#+#+   +#+            #
+#    Created: 2026/10/18 16:48:39 by cmariot          #+#    #+#              #
+#    Updated: 2026/10/18 16:48:39 by cmariot         ###   ########.fr        #
+#                                                                             #
+# *************************************************************************** #
+
+# Capture the query plans of the analytics queries and propose covering
+# indexes for the ones doing full scans.
+#
+# Run it from the root of the repository with:
+#     python -m common.explain [--only NAME] [--no-analyze] [--create]
+# Each run appends the plans and timings to the history file, to compare
+# them before and after creating the indexes.
+
+import io
+import os
+import re
+import json
+import argparse
+import contextlib
+import importlib.util
+from operator import methodcaller
+from datetime import datetime, timezone
+from common import database
+
+
+ROOT_DIRECTORY = os.path.normpath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+
+HISTORY_PATH = os.path.join(ROOT_DIRECTORY, "cache", "explain_history.jsonl")
+
+# Registered queries: name -> (script, function of the script module
+# returning the query). Only the SELECT queries without parameters are
+# registered, the EXPLAIN ANALYZE of the other ones would modify the data.
+QUERIES = {
+    "pie": (
+        "ds02/ex00/pie.py",
+        methodcaller("create_query")
+    ),
+    "pie_summaries": (
+        "ds02/ex00/pie.py",
+        methodcaller("create_summary_query")
+    ),
+    "chart_purchases": (
+        "ds02/ex01/chart.py",
+        methodcaller("create_query")
+    ),
+    "chart_daily": (
+        "ds02/ex01/chart.py",
+        methodcaller("create_daily_query")
+    ),
+    "chart_monthly": (
+        "ds02/ex01/chart.py",
+        methodcaller("create_monthly_query")
+    ),
+    "mustache_prices": (
+        "ds02/ex02/mustache.py",
+        methodcaller("create_query_1")
+    ),
+    "mustache_baskets": (
+        "ds02/ex02/mustache.py",
+        methodcaller("create_query_2")
+    ),
+    "mustache_prices_stats": (
+        "ds02/ex02/mustache.py",
+        lambda module: module.create_stats_query(
+            module.create_source_query(1)
+        )
+    ),
+    "building_frequency": (
+        "ds02/ex03/Building.py",
+        methodcaller("create_query_1")
+    ),
+    "building_monetary": (
+        "ds02/ex03/Building.py",
+        methodcaller("create_query_2")
+    ),
+    "rfm_purchases": (
+        "common/rfm.py",
+        methodcaller("create_purchases_query")
+    ),
+    "rfm_aggregates": (
+        "common/rfm.py",
+        methodcaller("create_aggregates_query")
+    ),
+    "rfm_version": (
+        "common/rfm.py",
+        methodcaller("create_version_query")
+    ),
+    "summaries_fingerprint": (
+        "common/summaries.py",
+        methodcaller("create_fingerprint_query")
+    ),
+}
+
+# Maximum length of a PostgreSQL identifier.
+MAX_IDENTIFIER_LENGTH = 63
+
+
+def load_query(name: str) -> str:
+    """
+    Import the script of the query 'name' and return its query, without
+    the SQL printed when it is created.
+    """
+    script, create_query = QUERIES[name]
+    path = os.path.join(ROOT_DIRECTORY, script)
+    spec = importlib.util.spec_from_file_location(
+        f"explain_{os.path.splitext(os.path.basename(script))[0]}", path
+    )
+    module = importlib.util.module_from_spec(spec)
+    with contextlib.redirect_stdout(io.StringIO()):
+        spec.loader.exec_module(module)
+        query = create_query(module)
+    return query.strip().rstrip(";")
+
+
+def explain(cursor, query: str, analyze: bool = True) -> dict:
+    """
+    Return the JSON plan of the query. With 'analyze', the query is run to
+    get the actual times, rows and buffers, in a transaction rolled back
+    afterwards.
+    """
+    options = "ANALYZE, BUFFERS, VERBOSE" if analyze else "VERBOSE"
+    cursor.execute(f"EXPLAIN ({options}, FORMAT JSON) {query}")
+    plan = cursor.fetchone()[0]
+    cursor.connection.rollback()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]
+
+
+def walk(node: dict):
+    """
+    Yield the node of a plan and all its children.
+    """
+    yield node
+    for child in node.get("Plans", []):
+        yield from walk(child)
+
+
+def get_columns(expressions, alias: str) -> list[str]:
+    """
+    Return the columns of the relation 'alias' used in the expressions, in
+    order of appearance and without duplicates.
+    """
+    if isinstance(expressions, str):
+        expressions = [expressions]
+    columns = []
+    for expression in expressions:
+        for column in re.findall(rf"\b{re.escape(alias)}\.(\w+)", expression):
+            if column not in columns:
+                columns.append(column)
+    return columns
+
+
+def get_equality_columns(condition: str, alias: str) -> list[str]:
+    """
+    Return the columns of the relation 'alias' compared with '=' in the
+    condition, which come first in the keys of an index.
+    """
+    return re.findall(
+        rf"\b{re.escape(alias)}\.(\w+)(?:\)|::[\w ]+?)* = ", condition
+    )
+
+
+def get_seq_scans(plan: dict) -> list[dict]:
+    """
+    Return the sequential scans of the plan: relation, filter, and the
+    columns it filters on, groups by and outputs.
+    """
+    group_keys = [
+        key
+        for node in walk(plan["Plan"])
+        for key in node.get("Group Key", []) + node.get("Sort Key", [])
+    ]
+    seq_scans = []
+    for node in walk(plan["Plan"]):
+        if node["Node Type"] != "Seq Scan":
+            continue
+        alias = node.get("Alias", node["Relation Name"])
+        condition = node.get("Filter", "")
+        seq_scans.append({
+            "relation": node["Relation Name"],
+            "schema": node.get("Schema", "public"),
+            "filter": condition,
+            "actual_rows": node.get("Actual Rows"),
+            "rows_removed_by_filter": node.get("Rows Removed by Filter"),
+            "equality_columns": get_equality_columns(condition, alias),
+            "filter_columns": get_columns(condition, alias),
+            "group_columns": get_columns(group_keys, alias),
+            "output_columns": get_columns(node.get("Output", []), alias),
+        })
+    return seq_scans
+
+
+def summarize(name: str, plan: dict) -> dict:
+    """
+    Return the entry of the history file of the plan of the query 'name'.
+    """
+    root = plan["Plan"]
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "name": name,
+        "planning_time": plan.get("Planning Time"),
+        "execution_time": plan.get("Execution Time"),
+        "total_cost": root.get("Total Cost"),
+        "shared_hit_blocks": root.get("Shared Hit Blocks"),
+        "shared_read_blocks": root.get("Shared Read Blocks"),
+        "seq_scans": get_seq_scans(plan),
+        "plan": plan,
+    }
+
+
+def append_history(entries: list[dict], path: str = HISTORY_PATH) -> None:
+    """
+    Append the entries to the history file, one JSON object per line.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as file:
+        for entry in entries:
+            file.write(json.dumps(entry, default=str) + "\n")
+
+
+def get_parent_table(cursor, schema: str, relation: str) -> str:
+    """
+    Return the partitioned table of the partition 'relation', or the
+    relation itself, an index created on a partitioned table being
+    created on all its partitions.
+    """
+    cursor.execute(
+        """
+        SELECT inhparent::regclass::text
+        FROM pg_inherits
+        WHERE inhrelid = %s::regclass;
+        """,
+        (f"{schema}.{relation}",)
+    )
+    parent = cursor.fetchone()
+    return parent[0] if parent is not None else relation
+
+
+def propose_index(table: str, seq_scan: dict) -> str | None:
+    """
+    Propose a covering index replacing the sequential scan by an index
+    only scan: the columns compared with '=' first, then the other
+    filtered columns and the grouped columns as keys, and the other
+    columns read by the query in INCLUDE.
+    Return None when the query filters and groups on nothing, the whole
+    table being read anyway.
+    """
+    keys = []
+    for column in (
+        seq_scan["equality_columns"]
+        + seq_scan["filter_columns"]
+        + seq_scan["group_columns"]
+    ):
+        if column not in keys:
+            keys.append(column)
+    if len(keys) == 0:
+        return None
+    included = [
+        column for column in seq_scan["output_columns"] if column not in keys
+    ]
+
+    name = "_".join([table.split(".")[-1], *keys, "covering_idx"])
+    name = name[:MAX_IDENTIFIER_LENGTH]
+    query = f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(keys)})"
+    if len(included) > 0:
+        query += f" INCLUDE ({', '.join(included)})"
+    return query + ";"
+
+
+def print_report(entry: dict, proposals: list[str]) -> None:
+
+    execution_time = entry["execution_time"]
+    print(f"\n{entry['name']}:")
+    if execution_time is not None:
+        print(
+            f"  executed in {execution_time:_.1f} ms, "
+            f"{entry['shared_hit_blocks']:_} blocks from the cache, "
+            f"{entry['shared_read_blocks']:_} read"
+        )
+    else:
+        print(f"  estimated cost {entry['total_cost']:_.0f}")
+    for seq_scan in entry["seq_scans"]:
+        rows = seq_scan["actual_rows"]
+        removed = seq_scan["rows_removed_by_filter"]
+        print(
+            f"  full scan of {seq_scan['relation']}"
+            + (f", {rows:_} rows kept" if rows is not None else "")
+            + (f", {removed:_} rows filtered out" if removed else "")
+        )
+    for proposal in proposals:
+        print(f"  proposed index: {proposal}")
+
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Capture the query plans of the analytics queries and "
+                    "propose covering indexes."
+    )
+    parser.add_argument(
+        "--only",
+        action="append",
+        choices=sorted(QUERIES),
+        metavar="NAME",
+        help="only explain this query, can be repeated "
+             f"(choices: {', '.join(sorted(QUERIES))})"
+    )
+    parser.add_argument(
+        "--no-analyze",
+        dest="analyze",
+        action="store_false",
+        help="only plan the queries instead of running them"
+    )
+    parser.add_argument(
+        "--create",
+        action="store_true",
+        help="create the proposed indexes, then vacuum and analyze the "
+             "indexed tables"
+    )
+    parser.add_argument(
+        "--history",
+        default=HISTORY_PATH,
+        metavar="PATH",
+        help="file the plans are appended to (default: %(default)s)"
+    )
+    return parser.parse_args()
+
+
+def main():
+
+    arguments = parse_arguments()
+    names = arguments.only or list(QUERIES)
+
+    entries = []
+    proposals = {}
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        for name in names:
+            plan = explain(cursor, load_query(name), arguments.analyze)
+            entry = summarize(name, plan)
+            entries.append(entry)
+
+            query_proposals = []
+            for seq_scan in entry["seq_scans"]:
+                table = get_parent_table(
+                    cursor, seq_scan["schema"], seq_scan["relation"]
+                )
+                proposal = propose_index(table, seq_scan)
+                if proposal is not None:
+                    query_proposals.append(proposal)
+                    proposals[proposal] = table
+            connection.rollback()
+            print_report(entry, query_proposals)
+
+        append_history(entries, arguments.history)
+        print(f"\nPlans appended to {arguments.history}")
+
+        if arguments.create and len(proposals) > 0:
+            connection.autocommit = True
+            for proposal in proposals:
+                cursor.execute(proposal)
+            for table in sorted(set(proposals.values())):
+                cursor.execute(f"VACUUM ANALYZE {table};")
+            print(f"{len(proposals)} indexes created.")
+        cursor.close()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as error:
+        print("Error:", error)
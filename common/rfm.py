@@ -0,0 +1,370 @@
+# *************************************************************************** #
+#                                                                             #
+#                                                        :::      ::::::::    #
+#    rfm.py                                            :+:      :+:    :+:    #
+#                                                    +:+ +:+         +:+      #
+#    By: cmariot <cmariot@student.42.fr>           +#+  +:+       +#+         #
+#                                                +#+#+#+#+#+   +#+            #
+#    Created: 2026/10/18 15:02:48 by cmariot          #+#    #+#              #
+#    Updated: 2026/10/18 15:02:48 by cmariot         ###   ########.fr        #
+#                                                                             #
+# *************************************************************************** #
+
+# Recency, frequency and monetary (RFM) features of the customers, shared
+# by ds02/ex04/elbow.py and ds02/ex05/Clustering.py.
+
+import os
+import hashlib
+import argparse
+from collections.abc import Iterable
+import pandas
+from common import database
+
+
+# The cache directory is found from the location of this file, at the
+# root of the repository, so the scripts can be run from any directory.
+CACHE_DIRECTORY = os.path.normpath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cache")
+)
+
+AGGREGATES_COLUMNS = [
+    "first_purchase",
+    "last_purchase",
+    "frequency",
+    "monetary"
+]
+
+
+def create_purchases_query() -> str:
+    """
+    Distinct purchases of the customers table.
+    The prices are fetched as DOUBLE PRECISION, so a NUMERIC price column
+    (--price-type numeric of the ds00 loaders) does not give Decimals.
+    """
+
+    query = (
+        """
+        SELECT
+            user_id,
+            event_time,
+            price::double precision AS price
+        FROM customers
+        WHERE event_type = 'purchase'
+        GROUP BY
+            user_id,
+            event_time,
+            price
+        ORDER BY user_id;
+        """
+    )
+    print(query)
+    return query
+
+
+def create_aggregates_query() -> str:
+    """
+    Same aggregates as aggregate_purchases, computed in the database.
+    """
+
+    query = (
+        """
+        SELECT
+            user_id,
+            MIN(event_time) AS first_purchase,
+            MAX(event_time) AS last_purchase,
+            COUNT(*) AS frequency,
+            SUM(price)::double precision AS monetary
+        FROM (
+            SELECT
+                user_id,
+                event_time,
+                price
+            FROM customers
+            WHERE event_type = 'purchase'
+            GROUP BY
+                user_id,
+                event_time,
+                price
+        ) AS purchases
+        GROUP BY user_id
+        ORDER BY user_id;
+        """
+    )
+    print(query)
+    return query
+
+
+def create_changed_aggregates_query() -> str:
+    """
+    Same aggregates as create_aggregates_query, only for the users with a
+    purchase since %(since)s, computed from all their purchases.
+    """
+
+    query = (
+        """
+        SELECT
+            user_id,
+            MIN(event_time) AS first_purchase,
+            MAX(event_time) AS last_purchase,
+            COUNT(*) AS frequency,
+            SUM(price)::double precision AS monetary
+        FROM (
+            SELECT
+                user_id,
+                event_time,
+                price
+            FROM customers
+            WHERE event_type = 'purchase'
+            AND user_id IN (
+                SELECT user_id
+                FROM customers
+                WHERE event_type = 'purchase'
+                AND event_time >= %(since)s
+            )
+            GROUP BY
+                user_id,
+                event_time,
+                price
+        ) AS purchases
+        GROUP BY user_id
+        ORDER BY user_id;
+        """
+    )
+    print(query)
+    return query
+
+
+def create_version_query() -> str:
+    """
+    Cheap fingerprint of the purchases of the customers table, which
+    changes whenever purchases are added, removed or modified.
+    The prices are summed as NUMERIC so the result does not depend on the
+    order in which the rows are read.
+    """
+
+    query = (
+        """
+        SELECT
+            COUNT(*),
+            MIN(event_time),
+            MAX(event_time),
+            SUM(price::numeric)
+        FROM customers
+        WHERE event_type = 'purchase';
+        """
+    )
+    print(query)
+    return query
+
+
+def get_data_version() -> str:
+    """
+    Return a short hash of the fingerprint of the purchases.
+    """
+    fingerprint = database.fetch_all(create_version_query())[0]
+    return hashlib.sha256(repr(fingerprint).encode()).hexdigest()[:16]
+
+
+def aggregate_purchases(batches: Iterable[list]) -> pandas.DataFrame:
+    """
+    Aggregate the purchases by user_id, batch by batch: date of the first
+    and last purchase, number of purchases and total spent.
+    Only the aggregates of the batches are kept, and they are merged at
+    the end, so the memory used does not depend on the number of
+    purchases.
+    The event times are converted to UTC: with a session TimeZone having
+    DST, psycopg2 returns them with different offsets, which pandas would
+    store as objects instead of datetimes.
+    """
+    partial_aggregates = []
+    for batch in batches:
+        purchases = pandas.DataFrame(
+            batch,
+            columns=[
+                "user_id",
+                "event_time",
+                "price"
+            ]
+        )
+        purchases["event_time"] = pandas.to_datetime(
+            purchases["event_time"], utc=True
+        )
+        partial_aggregates.append(
+            purchases.groupby("user_id").agg(
+                first_purchase=("event_time", "min"),
+                last_purchase=("event_time", "max"),
+                frequency=("event_time", "count"),
+                monetary=("price", "sum")
+            )
+        )
+    return pandas.concat(partial_aggregates).groupby(level="user_id").agg(
+        first_purchase=("first_purchase", "min"),
+        last_purchase=("last_purchase", "max"),
+        frequency=("frequency", "sum"),
+        monetary=("monetary", "sum")
+    )
+
+
+def fetch_aggregates(
+    stream: bool = False,
+    pushdown: bool = False,
+    itersize: int = database.STREAM_ITERSIZE
+) -> pandas.DataFrame:
+    """
+    Return the aggregates of the purchases per user_id:
+    - pushdown: computed by the database,
+    - stream: computed from batches of purchases of a server-side cursor,
+    - otherwise: computed from all the purchases fetched at once.
+    The dates of the first and last purchase are in UTC.
+    """
+    if pushdown:
+        data = database.fetch_all(create_aggregates_query())
+        aggregates = pandas.DataFrame(
+            data,
+            columns=["user_id", *AGGREGATES_COLUMNS]
+        ).set_index("user_id")
+        for column in ("first_purchase", "last_purchase"):
+            aggregates[column] = pandas.to_datetime(
+                aggregates[column], utc=True
+            )
+        return aggregates
+    if stream:
+        batches = database.fetch_batches(
+            create_purchases_query(), itersize=itersize
+        )
+    else:
+        batches = [database.fetch_all(create_purchases_query())]
+    return aggregate_purchases(batches)
+
+
+def get_cache_path(version: str) -> str:
+    return os.path.join(CACHE_DIRECTORY, f"rfm_{version}.parquet")
+
+
+def get_aggregates(
+    stream: bool = False,
+    pushdown: bool = False,
+    itersize: int = database.STREAM_ITERSIZE,
+    use_cache: bool = True
+) -> pandas.DataFrame:
+    """
+    Same as fetch_aggregates, cached in a Parquet file named after the
+    version of the data, so they are only computed again once the
+    purchases of the customers table changed.
+    """
+    if not use_cache:
+        return fetch_aggregates(stream, pushdown, itersize)
+
+    cache_path = get_cache_path(get_data_version())
+    if os.path.isfile(cache_path):
+        print(f"Loading the RFM aggregates from {cache_path}")
+        return pandas.read_parquet(cache_path)
+
+    aggregates = fetch_aggregates(stream, pushdown, itersize)
+
+    # Write to a temporary file first so an interrupted run never leaves a
+    # truncated cache, and remove the caches of the older versions.
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    for filename in os.listdir(CACHE_DIRECTORY):
+        if filename.startswith("rfm_") and filename.endswith(".parquet"):
+            os.remove(os.path.join(CACHE_DIRECTORY, filename))
+    aggregates.to_parquet(f"{cache_path}.tmp")
+    os.replace(f"{cache_path}.tmp", cache_path)
+    print(f"RFM aggregates cached in {cache_path}")
+    return aggregates
+
+
+def get_reference_date(
+    aggregates: pandas.DataFrame,
+    recency_from: str = "end"
+):
+    """
+    Date from which the recency is counted: the last purchase in the data
+    with recency_from "end", the first purchase with "start".
+    """
+    if recency_from == "end":
+        return aggregates["last_purchase"].max()
+    if recency_from == "start":
+        return aggregates["first_purchase"].min()
+    raise ValueError(f"Invalid recency_from: {recency_from}")
+
+
+def compute_features(
+    aggregates: pandas.DataFrame,
+    recency_from: str = "end",
+    reference_date=None
+) -> pandas.DataFrame:
+    """
+    Compute the recency, frequency and monetary features of each user from
+    the aggregates of its purchases.
+    The recency is the number of days, the minimum value being 1:
+    - recency_from "end": since the last purchase of the user, counted
+      back from the last purchase in the data,
+    - recency_from "start": from the first purchase in the data to the
+      last purchase of the user.
+    A 'reference_date' replaces the first or last purchase in the data,
+    to compute the features of new users the same way as the ones a
+    model was fitted on.
+    """
+    if reference_date is None:
+        reference_date = get_reference_date(aggregates, recency_from)
+    if recency_from == "end":
+        days = (reference_date - aggregates["last_purchase"]).dt.days
+    elif recency_from == "start":
+        days = (aggregates["last_purchase"] - reference_date).dt.days
+    else:
+        raise ValueError(f"Invalid recency_from: {recency_from}")
+
+    return pandas.DataFrame(
+        {
+            "recency": days + 1,
+            "frequency": aggregates["frequency"],
+            "monetary": aggregates["monetary"],
+        },
+        index=aggregates.index
+    )
+
+
+def get_features(
+    recency_from: str = "end",
+    stream: bool = False,
+    pushdown: bool = False,
+    itersize: int = database.STREAM_ITERSIZE,
+    use_cache: bool = True
+) -> pandas.DataFrame:
+    """
+    Return the RFM features of each user, indexed by user_id.
+    """
+    aggregates = get_aggregates(stream, pushdown, itersize, use_cache)
+    return compute_features(aggregates, recency_from)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Add the command line arguments selecting how the features are built.
+    """
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--stream",
+        action="store_true",
+        help="stream the purchases from a server-side cursor instead of "
+             "fetching them all at once"
+    )
+    mode.add_argument(
+        "--pushdown",
+        action="store_true",
+        help="aggregate the purchases per user in the database instead of "
+             "fetching them"
+    )
+    parser.add_argument(
+        "--itersize",
+        type=int,
+        default=database.STREAM_ITERSIZE,
+        help="number of rows per batch with --stream (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="use_cache",
+        action="store_false",
+        help=f"do not read nor write the features cache in {CACHE_DIRECTORY}"
+    )
@@ -0,0 +1,276 @@
+# *************************************************************************** #
+#                                                                             #
+#                                                        :::      ::::::::    #
+#    summaries.py                                      :+:      :+:    :+:    #
+#                                                    +:+ +:+         +:+      #
+#    By: cmariot <cmariot@student.42.fr>           +#+  +:+       +#+         #
+#                                                +#+#+#+#+#+   +#+            #
+#    Created: 2026/10/18 14:37:05 by cmariot          #+#    #+#              #
+#    Updated: 2026/10/18 14:37:05 by cmariot         ###   ########.fr        #
+#                                                                             #
+# *************************************************************************** #
+
+# Summary tables of the customers table, read by the ds02 dashboards
+# instead of scanning the whole customers table on every run.
+#
+# Refresh them after building the customers table (ds01) with:
+#     python -m common.summaries [--full]
+# Only the months whose data changed since the last refresh are
+# recomputed.
+
+import argparse
+from datetime import datetime, timezone
+from common import database
+
+
+def create_tables_query() -> str:
+    """
+    Create the summary tables if they do not exist:
+    - summary_daily_events: number of events per day and event_type.
+    - summary_baskets: number of items and price of each basket, the
+      purchases of a user at the same event_time.
+    - summary_users: purchases, total spent and average basket price per
+      user, aggregated from summary_baskets.
+    - summary_months: fingerprint of the data of each month of the
+      customers table when it was last summarized.
+    The days and months are in UTC.
+    """
+    query = (
+        """
+        CREATE TABLE IF NOT EXISTS summary_daily_events
+        (
+            day             DATE NOT NULL,
+            event_type      TEXT NOT NULL,
+            events          BIGINT NOT NULL,
+            PRIMARY KEY (day, event_type)
+        );
+        CREATE TABLE IF NOT EXISTS summary_baskets
+        (
+            user_id         BIGINT NOT NULL,
+            event_time      TIMESTAMP WITH TIME ZONE NOT NULL,
+            items           BIGINT NOT NULL,
+            basket_price    DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (user_id, event_time)
+        );
+        CREATE INDEX IF NOT EXISTS summary_baskets_event_time_idx
+            ON summary_baskets (event_time);
+        CREATE TABLE IF NOT EXISTS summary_users
+        (
+            user_id             BIGINT PRIMARY KEY,
+            purchases           BIGINT NOT NULL,
+            spent               DOUBLE PRECISION NOT NULL,
+            baskets             BIGINT NOT NULL,
+            avg_basket_price    DOUBLE PRECISION NOT NULL,
+            first_purchase      TIMESTAMP WITH TIME ZONE NOT NULL,
+            last_purchase       TIMESTAMP WITH TIME ZONE NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS summary_months
+        (
+            month           DATE PRIMARY KEY,
+            events          BIGINT NOT NULL,
+            sales           NUMERIC NOT NULL,
+            last_event_time TIMESTAMP WITH TIME ZONE NOT NULL,
+            refreshed_at    TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+        );
+        """
+    )
+    print(query)
+    return query
+
+
+def create_fingerprint_query() -> str:
+    """
+    Compute a fingerprint of each month of the customers table: its
+    number of events, total price and last event_time.
+    The prices are summed as NUMERIC so the result does not depend on the
+    order in which the rows are read.
+    """
+    query = (
+        """
+        SELECT
+            date_trunc('month', event_time AT TIME ZONE 'UTC')::date
+                AS month,
+            COUNT(*) AS events,
+            COALESCE(SUM(price::numeric), 0) AS sales,
+            MAX(event_time) AS last_event_time
+        FROM customers
+        WHERE event_time IS NOT NULL
+        GROUP BY month
+        ORDER BY month;
+        """
+    )
+    print(query)
+    return query
+
+
+def create_refresh_query() -> str:
+    """
+    Recompute the summaries of the events between %(start)s and %(end)s.
+    The users having a basket in this range, before or after the refresh,
+    are aggregated again from all their baskets.
+    """
+    query = (
+        """
+        CREATE TEMP TABLE refreshed_users ON COMMIT DROP AS
+            SELECT DISTINCT user_id
+            FROM summary_baskets
+            WHERE event_time >= %(start)s AND event_time < %(end)s;
+
+        DELETE FROM summary_daily_events
+            WHERE day >= (%(start)s AT TIME ZONE 'UTC')::date
+            AND day < (%(end)s AT TIME ZONE 'UTC')::date;
+        INSERT INTO summary_daily_events (day, event_type, events)
+            SELECT
+                (event_time AT TIME ZONE 'UTC')::date AS day,
+                event_type::text,
+                COUNT(*)
+            FROM customers
+            WHERE event_time >= %(start)s AND event_time < %(end)s
+            AND event_type IS NOT NULL
+            GROUP BY day, event_type;
+
+        DELETE FROM summary_baskets
+            WHERE event_time >= %(start)s AND event_time < %(end)s;
+        INSERT INTO summary_baskets (user_id, event_time, items, basket_price)
+            SELECT user_id, event_time, COUNT(*), SUM(price)
+            FROM customers
+            WHERE event_type = 'purchase'
+            AND event_time >= %(start)s AND event_time < %(end)s
+            AND user_id IS NOT NULL AND price IS NOT NULL
+            GROUP BY user_id, event_time;
+
+        INSERT INTO refreshed_users
+            SELECT DISTINCT user_id
+            FROM summary_baskets
+            WHERE event_time >= %(start)s AND event_time < %(end)s;
+
+        DELETE FROM summary_users
+            WHERE user_id IN (SELECT user_id FROM refreshed_users);
+        INSERT INTO summary_users
+            SELECT
+                user_id,
+                SUM(items),
+                SUM(basket_price),
+                COUNT(*),
+                AVG(basket_price),
+                MIN(event_time),
+                MAX(event_time)
+            FROM summary_baskets
+            WHERE user_id IN (SELECT user_id FROM refreshed_users)
+            GROUP BY user_id;
+        """
+    )
+    return query
+
+
+def get_month_bounds(month) -> tuple[datetime, datetime]:
+    """
+    Return the first instant, in UTC, of the month of the date 'month' and
+    of the next month.
+    """
+    start = datetime(month.year, month.month, 1, tzinfo=timezone.utc)
+    if month.month == 12:
+        end = start.replace(year=month.year + 1, month=1)
+    else:
+        end = start.replace(month=month.month + 1)
+    return start, end
+
+
+def refresh(full: bool = False) -> None:
+    """
+    Refresh the summary tables from the customers table.
+    The months whose fingerprint changed since the last refresh, or which
+    were never summarized, are recomputed one by one, each in its own
+    transaction. The months which are no longer in the customers table
+    are removed from the summaries.
+    With 'full', all the summaries are rebuilt from scratch.
+    """
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(create_tables_query())
+        if full:
+            cursor.execute(
+                """
+                TRUNCATE summary_daily_events, summary_baskets,
+                         summary_users, summary_months;
+                """
+            )
+        connection.commit()
+
+        cursor.execute(create_fingerprint_query())
+        fingerprints = {
+            month: (events, sales, last_event_time)
+            for month, events, sales, last_event_time in cursor.fetchall()
+        }
+        cursor.execute(
+            "SELECT month, events, sales, last_event_time "
+            "FROM summary_months;"
+        )
+        summarized = {
+            month: (events, sales, last_event_time)
+            for month, events, sales, last_event_time in cursor.fetchall()
+        }
+
+        months = sorted(
+            month for month in fingerprints.keys() | summarized.keys()
+            if fingerprints.get(month) != summarized.get(month)
+        )
+        if len(months) == 0:
+            print("The summaries are up to date.")
+        else:
+            print(create_refresh_query())
+
+        for month in months:
+            start, end = get_month_bounds(month)
+            cursor.execute(
+                create_refresh_query(), {"start": start, "end": end}
+            )
+            cursor.execute(
+                "DELETE FROM summary_months WHERE month = %s;", (month,)
+            )
+            if month in fingerprints:
+                cursor.execute(
+                    """
+                    INSERT INTO summary_months
+                        (month, events, sales, last_event_time)
+                        VALUES (%s, %s, %s, %s);
+                    """,
+                    (month, *fingerprints[month])
+                )
+            connection.commit()
+            print(f"Summaries of {month:%Y-%m} refreshed.")
+
+        cursor.execute("ANALYZE summary_daily_events;")
+        cursor.execute("ANALYZE summary_baskets;")
+        cursor.execute("ANALYZE summary_users;")
+        connection.commit()
+        cursor.close()
+
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Refresh the summary tables of the customers table."
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="rebuild all the summaries instead of only the months which "
+             "changed"
+    )
+    return parser.parse_args()
+
+
+def main():
+
+    arguments = parse_arguments()
+    refresh(arguments.full)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as error:
+        print("Error:", error)
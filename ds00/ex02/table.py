@@ -11,82 +11,101 @@
 # *************************************************************************** #
 
 import os
-from dotenv import load_dotenv
-import psycopg2
+import sys
+import argparse
 
-
-def load_env(dotenv_path: str) -> tuple:
-    """
-    Load the postgresql config from the .env_postgres file.
-    Return a tuple with the config.
-    """
-    env_file_loaded = load_dotenv(dotenv_path)
-    if env_file_loaded is False:
-        raise FileNotFoundError(
-            "The .env_postgres file is missing or is empty."
-        )
-    environment_variables = (
-        os.getenv('POSTGRES_HOST'),
-        os.getenv('POSTGRES_DB'),
-        os.getenv('POSTGRES_USER'),
-        os.getenv('POSTGRES_PASSWORD'),
-        os.getenv('POSTGRES_PORT')
-    )
-    if any(variable is None for variable in environment_variables):
-        raise ValueError(
-            "One or more config variables are missing.\n" +
-            "Please check the .env_postgres file."
-        )
-    return environment_variables
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+)
+from common import database, columns, csv_copy  # noqa: E402
 
 
-def create_query(table_name: str, path: str) -> str:
+def create_query(
+    table_name: str,
+    path: str | None,
+    column_types: dict[str, str] | None = None
+) -> str:
     """
     Create table 'table_name' with the data from the CSV file 'path' in the
     docker container and copy the data from the CSV file to the table.
+    If 'path' is None, only the table is created.
+    The types of the event_type, price and user_session columns are the
+    ones of 'column_types' (see columns.get_column_types). An existing
+    table is kept as is, main checks that its types are the same ones
+    (see columns.check_column_types).
     """
+    if column_types is None:
+        column_types = columns.get_column_types()
+    copy_statement = (
+        f"COPY {table_name} FROM '{path}' CSV HEADER;"
+        if path is not None else ""
+    )
     query = (
         f"""
         CREATE TABLE IF NOT EXISTS {table_name}
         (
             event_time      TIMESTAMP WITH TIME ZONE,
-            event_type      VARCHAR(32),
+            event_type      {column_types["event_type"]},
             product_id      INTEGER,
-            price           FLOAT,
+            price           {column_types["price"]},
             user_id         BIGINT,
-            user_session    TEXT
+            user_session    {column_types["user_session"]}
         );
-        COPY {table_name} FROM '{path}' CSV HEADER;
+        {copy_statement}
         """
     )
     print(query)
     return query
 
 
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Create the data_2022_oct table from its CSV file."
+    )
+    parser.add_argument(
+        "--stdin",
+        metavar="PATH",
+        nargs="?",
+        const="../../subject/customer/data_2022_oct.csv",
+        help="stream the local CSV file PATH (optionally .gz or .zst "
+             "compressed) with COPY FROM STDIN instead of reading it from "
+             "the docker container (default PATH: %(const)s)"
+    )
+    columns.add_arguments(parser)
+    return parser.parse_args()
+
+
 def main():
 
-    (host, database, username, password, port) = load_env(
-        "../../postgresql_docker/.env_postgres"
-    )
+    arguments = parse_arguments()
 
+    column_types = columns.get_column_types(
+        arguments.compact, arguments.price_type
+    )
     query: str = create_query(
         table_name="data_2022_oct",
-        path="/subject/customer/data_2022_oct.csv"
-    )
-
-    connection = psycopg2.connect(
-        host=host,
-        database=database,
-        user=username,
-        password=password,
-        port=port
+        path=(
+            None if arguments.stdin
+            else "/subject/customer/data_2022_oct.csv"
+        ),
+        column_types=column_types
     )
 
-    cursor = connection.cursor()
-    cursor.execute(query)
-    connection.commit()
-    cursor.close()
-    connection.close()
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        if arguments.compact:
+            cursor.execute(columns.create_enum_query())
+        columns.check_column_types(cursor, "data_2022_oct", column_types)
+        cursor.execute(query)
+        if arguments.stdin:
+            csv_copy.copy_from_stdin(
+                cursor, "data_2022_oct", arguments.stdin
+            )
+        connection.commit()
+        cursor.close()
 
 
 if __name__ == "__main__":
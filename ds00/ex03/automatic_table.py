@@ -11,36 +11,34 @@
 # *************************************************************************** #
 
 import os
-from dotenv import load_dotenv
+import sys
+import time
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import psycopg2
 
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+)
+from common import database, columns, csv_copy  # noqa: E402
 
-def load_env(dotenv_path: str) -> tuple:
-    """
-    Load the postgresql config from the .env_postgres file.
-    Return a tuple with the config.
-    """
-    env_file_loaded = load_dotenv(dotenv_path)
-    if env_file_loaded is False:
-        raise FileNotFoundError(
-            "The .env_postgres file is missing or is empty."
-        )
-    environment_variables = (
-        os.getenv('POSTGRES_HOST'),
-        os.getenv('POSTGRES_DB'),
-        os.getenv('POSTGRES_USER'),
-        os.getenv('POSTGRES_PASSWORD'),
-        os.getenv('POSTGRES_PORT')
-    )
-    if any(variable is None for variable in environment_variables):
-        raise ValueError(
-            "One or more config variables are missing.\n" +
-            "Please check the .env_postgres file."
-        )
-    return environment_variables
+# Extensions of the files streamed with --stdin, the compressed ones are
+# decompressed on the fly.
+STDIN_EXTENSIONS = (".csv", ".csv.gz", ".csv.zst")
+
+# Columns indexed after a --bulk load, used to filter and group the
+# customers data in ds01 and ds02.
+INDEXED_COLUMNS = ("event_type", "user_id", "product_id", "event_time")
+
+# Table recording the files loaded with --incremental.
+MANIFEST_TABLE = "load_manifest"
 
 
-def get_files_list(directory: str) -> list[str]:
+def get_files_list(
+    directory: str,
+    extensions: tuple[str, ...] = (".csv",)
+) -> list[str]:
     """
     Return the list of the CSV files in the directory.
     If the directory is empty or does not contain any CSV files,
@@ -49,7 +47,7 @@ def get_files_list(directory: str) -> list[str]:
     csv_list = []
     files_list = os.listdir(directory)
     for file in files_list:
-        if file.endswith(".csv"):
+        if file.endswith(extensions):
             csv_list.append(file)
     if len(csv_list) == 0:
         raise FileNotFoundError(
@@ -58,56 +56,571 @@ def get_files_list(directory: str) -> list[str]:
     return csv_list
 
 
-def create_query(table_name: str, path: str) -> str:
+def get_table_name(filename: str) -> str:
+    """
+    Return the name of the table created from the CSV file 'filename',
+    which is the filename without its extension.
+    """
+    for extension in sorted(STDIN_EXTENSIONS, key=len, reverse=True):
+        if filename.endswith(extension):
+            return filename[:-len(extension)]
+    return filename
+
+
+def create_query(
+    table_name: str,
+    path: str | None,
+    unlogged: bool = False,
+    column_types: dict[str, str] | None = None
+) -> str:
     """
     Create table 'table_name' with the data from the CSV file 'path' in the
     docker container and copy the data from the CSV file to the table.
+    If 'path' is None, only the table is created.
+    An unlogged table skips the WAL, which makes the COPY faster but the
+    table is emptied if the server crashes.
+    The types of the event_type, price and user_session columns are the
+    ones of 'column_types' (see columns.get_column_types).
     """
+    if column_types is None:
+        column_types = columns.get_column_types()
+    copy_statement = (
+        f"COPY {table_name} FROM '{path}' CSV HEADER;"
+        if path is not None else ""
+    )
     query = (
         f"""
         DROP TABLE IF EXISTS {table_name};
-        CREATE TABLE {table_name}
+        CREATE {"UNLOGGED " if unlogged else ""}TABLE {table_name}
         (
             event_time      TIMESTAMP WITH TIME ZONE,
-            event_type      VARCHAR(32),
+            event_type      {column_types["event_type"]},
             product_id      INTEGER,
-            price           FLOAT,
+            price           {column_types["price"]},
             user_id         BIGINT,
-            user_session    TEXT
+            user_session    {column_types["user_session"]}
         );
-        COPY {table_name} FROM '{path}' CSV HEADER;
+        {copy_statement}
         """
     )
     print(query)
     return query
 
 
-def main():
+def index_name(table_name: str, column: str) -> str:
+    """
+    Return the name of the index on the column 'column' of 'table_name'.
+    """
+    return f"{table_name}_{column}_idx"
 
-    (host, database, username, password, port) = load_env(
-        "../../postgresql_docker/.env_postgres"
+
+def create_index_query(table_name: str) -> str:
+    """
+    Make the freshly loaded table 'table_name' a regular logged table,
+    build its indexes and collect its statistics for the planner.
+    Building the indexes once the data is in is much faster than
+    maintaining them row by row during the COPY. They are built after
+    SET LOGGED, which rewrites the table and would rebuild them again.
+    """
+    index_statements = "".join(
+        f"""
+        CREATE INDEX {index_name(table_name, column)}
+            ON {table_name} ({column});"""
+        for column in INDEXED_COLUMNS
+    )
+    query = (
+        f"""
+        ALTER TABLE {table_name} SET LOGGED;{index_statements}
+        ANALYZE {table_name};
+        """
     )
+    print(query)
+    return query
+
+
+def load_table(
+    cursor: psycopg2.extensions.cursor,
+    table_name: str,
+    file_path: str,
+    stdin: bool,
+    bulk: bool = False,
+    column_types: dict[str, str] | None = None
+) -> int:
+    """
+    Create the table 'table_name' and copy the CSV file 'file_path' in it,
+    either from the docker container or streamed from the local file if
+    'stdin' is True.
+    With 'bulk', the data is copied in an unlogged table whose indexes are
+    built afterwards.
+    The columns have the types of 'column_types'.
+    Return the number of rows copied.
+    """
+    if stdin:
+        cursor.execute(create_query(table_name, None, bulk, column_types))
+        rows = csv_copy.copy_from_stdin(cursor, table_name, file_path)
+    else:
+        cursor.execute(
+            create_query(table_name, file_path, bulk, column_types)
+        )
+        rows = cursor.rowcount
+    if bulk:
+        cursor.execute(create_index_query(table_name))
+    return rows
+
 
-    connection = psycopg2.connect(
-        host=host,
-        database=database,
-        user=username,
-        password=password,
-        port=port
+def staging_name(table_name: str) -> str:
+    """
+    Return the name of the table in which 'table_name' is loaded before
+    being swapped in.
+    """
+    return f"{table_name}_staging"
+
+
+def create_swap_query(table_names: list[str], indexed: bool) -> str:
+    """
+    Replace each table of 'table_names' by its staging table.
+    All the tables are swapped in the same transaction, so the database
+    never holds a mix of old and new months.
+    If the staging tables are 'indexed', their indexes are renamed too so
+    the next load can create them again.
+    """
+    query = ""
+    for table_name in table_names:
+        query += (
+            f"""
+        DROP TABLE IF EXISTS {table_name};
+        ALTER TABLE {staging_name(table_name)} RENAME TO {table_name};"""
+        )
+        if indexed:
+            query += "".join(
+                f"""
+        ALTER INDEX {index_name(staging_name(table_name), column)}
+            RENAME TO {index_name(table_name, column)};"""
+                for column in INDEXED_COLUMNS
+            )
+    query += "\n"
+    print(query)
+    return query
+
+
+def create_drop_staging_query(table_names: list[str]) -> str:
+    """
+    Drop the staging tables of 'table_names' after a failed load.
+    """
+    query = "".join(
+        f"""
+        DROP TABLE IF EXISTS {staging_name(table_name)};
+        """
+        for table_name in table_names
     )
+    print(query)
+    return query
 
-    data_dirpath_on_container = "/subject/customer/"
-    filenames = get_files_list("../../subject/customer")
-    table_names = [file[:-4] for file in filenames]
-    file_paths = [data_dirpath_on_container + file for file in filenames]
 
-    cursor = connection.cursor()
-    for table_name, file_path in zip(table_names, file_paths):
-        query: str = create_query(table_name, file_path)
+def detach_from_customers(
+    cursor: psycopg2.extensions.cursor,
+    table_names: list[str]
+) -> None:
+    """
+    Detach the tables of 'table_names' attached as partitions of the
+    customers table by ds01/ex01/customers_table.py --partitioned, before
+    they are dropped or swapped, and warn that customers does not hold
+    their rows anymore.
+    """
+    partitions = database.get_partitions(cursor, "customers")
+    for table_name in table_names:
+        if table_name not in partitions:
+            continue
+        print(
+            f"Warning: {table_name} is a partition of customers, it is "
+            f"detached and its rows are not in customers anymore until "
+            f"customers_table.py is run again."
+        )
+        query = f"ALTER TABLE customers DETACH PARTITION {table_name};"
+        print(query)
         cursor.execute(query)
+
+
+def load_file(
+    table_name: str,
+    file_path: str,
+    stdin: bool,
+    bulk: bool,
+    column_types: dict[str, str] | None = None
+) -> tuple[int, float]:
+    """
+    Load the CSV file 'file_path' in the staging table of 'table_name' on
+    its own pooled connection.
+    Return the number of rows copied and the elapsed time in seconds.
+    """
+    start = time.perf_counter()
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        rows = load_table(
+            cursor, staging_name(table_name), file_path, stdin, bulk,
+            column_types
+        )
+        connection.commit()
+        cursor.close()
+    return rows, time.perf_counter() - start
+
+
+def load_files(
+    table_names: list[str],
+    file_paths: list[str],
+    workers: int,
+    stdin: bool,
+    bulk: bool,
+    column_types: dict[str, str] | None = None
+) -> dict[str, int]:
+    """
+    Load each CSV file in a staging table on its own pooled connection,
+    with at most 'workers' loads running at the same time.
+    The staging tables are swapped in only if all the loads succeeded,
+    otherwise they are dropped and the first error is raised.
+    Return the number of rows copied by table name.
+    """
+    start = time.perf_counter()
+    errors = []
+    rows_per_table = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                load_file,
+                table_name,
+                file_path,
+                stdin,
+                bulk,
+                column_types
+            ): table_name
+            for table_name, file_path in zip(table_names, file_paths)
+        }
+        for future in as_completed(futures):
+            table_name = futures[future]
+            try:
+                rows, elapsed = future.result()
+            except Exception as error:
+                print(f"{table_name}: load failed: {error}")
+                errors.append(error)
+                continue
+            rows_per_table[table_name] = rows
+            print(
+                f"{table_name}: {rows:_} rows in {elapsed:.2f}s " +
+                f"({rows / elapsed:_.0f} rows/s)"
+            )
+
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        if errors:
+            cursor.execute(create_drop_staging_query(table_names))
+        else:
+            detach_from_customers(cursor, table_names)
+            cursor.execute(create_swap_query(table_names, indexed=bulk))
         connection.commit()
-    cursor.close()
-    connection.close()
+        cursor.close()
+    if errors:
+        raise errors[0]
+
+    print(
+        f"{len(table_names)} files loaded in " +
+        f"{time.perf_counter() - start:.2f}s with {workers} workers"
+    )
+    return rows_per_table
+
+
+def load_files_serially(
+    table_names: list[str],
+    file_paths: list[str],
+    stdin: bool,
+    column_types: dict[str, str] | None = None
+) -> dict[str, int]:
+    """
+    Load the CSV files one after the other on a single connection,
+    committing after each table.
+    Return the number of rows copied by table name.
+    """
+    rows_per_table = {}
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        for table_name, file_path in zip(table_names, file_paths):
+            detach_from_customers(cursor, [table_name])
+            rows_per_table[table_name] = load_table(
+                cursor, table_name, file_path, stdin,
+                column_types=column_types
+            )
+            connection.commit()
+        cursor.close()
+    return rows_per_table
+
+
+def create_manifest_query() -> str:
+    """
+    Create the manifest table, which records for each loaded table the
+    size, modification time and SHA-256 of its CSV file, the options it
+    was loaded with and the number of rows copied from it.
+    The load_options column is added to the manifests created before it.
+    """
+    query = (
+        f"""
+        CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE}
+        (
+            table_name      TEXT PRIMARY KEY,
+            file_name       TEXT NOT NULL,
+            file_size       BIGINT NOT NULL,
+            file_mtime_ns   BIGINT NOT NULL,
+            file_hash       TEXT NOT NULL,
+            load_options    TEXT NOT NULL DEFAULT '',
+            row_count       BIGINT NOT NULL,
+            loaded_at       TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+        );
+        ALTER TABLE {MANIFEST_TABLE}
+            ADD COLUMN IF NOT EXISTS load_options TEXT NOT NULL DEFAULT '';
+        """
+    )
+    print(query)
+    return query
+
+
+def get_load_options(bulk: bool, column_types: dict[str, str]) -> str:
+    """
+    Return the options changing the tables built from the CSV files, as
+    recorded in the manifest: whether they are indexed by --bulk, and the
+    types of their columns (--compact, --price-type).
+    """
+    options = [f"bulk={bulk}"] + [
+        f"{column}={column_type}"
+        for column, column_type in sorted(column_types.items())
+    ]
+    return " ".join(options)
+
+
+def hash_file(path: str) -> str:
+    """
+    Return the SHA-256 of the file 'path', read in chunks.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(csv_copy.COPY_BUFFER_SIZE):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def select_files_to_load(
+    cursor: psycopg2.extensions.cursor,
+    table_names: list[str],
+    local_paths: list[str],
+    load_options: str
+) -> dict[str, tuple]:
+    """
+    Compare the local CSV files with the manifest and return the
+    fingerprint (file name, size, mtime in ns, hash, load options) of the
+    ones which are new or modified, by table name.
+    Files loaded with other options than 'load_options' (see
+    get_load_options) are reloaded even if they did not change.
+    The files are only hashed when their size or mtime changed. A file
+    which was touched without being modified is not reloaded, its new
+    mtime is recorded in the manifest instead.
+    Tables recorded in the manifest but missing from the database are
+    reloaded.
+    """
+    cursor.execute(
+        f"""
+        SELECT table_name, file_size, file_mtime_ns, file_hash
+            FROM {MANIFEST_TABLE}
+            WHERE to_regclass(table_name) IS NOT NULL
+            AND load_options = %s;
+        """,
+        (load_options,)
+    )
+    manifest = {
+        table_name: (size, mtime_ns, file_hash)
+        for table_name, size, mtime_ns, file_hash in cursor.fetchall()
+    }
+
+    files_to_load = {}
+    for table_name, local_path in zip(table_names, local_paths):
+        status = os.stat(local_path)
+        loaded = manifest.get(table_name)
+        if loaded is not None and loaded[:2] == (
+            status.st_size, status.st_mtime_ns
+        ):
+            print(f"{table_name}: unchanged, skipped")
+            continue
+        file_hash = hash_file(local_path)
+        if loaded is not None and loaded[2] == file_hash:
+            print(f"{table_name}: touched but unchanged, skipped")
+            cursor.execute(
+                f"""
+                UPDATE {MANIFEST_TABLE}
+                    SET file_size = %s, file_mtime_ns = %s
+                    WHERE table_name = %s;
+                """,
+                (status.st_size, status.st_mtime_ns, table_name)
+            )
+            continue
+        files_to_load[table_name] = (
+            os.path.basename(local_path),
+            status.st_size,
+            status.st_mtime_ns,
+            file_hash,
+            load_options
+        )
+    return files_to_load
+
+
+def update_manifest(
+    cursor: psycopg2.extensions.cursor,
+    fingerprints: dict[str, tuple],
+    rows: dict[str, int]
+) -> None:
+    """
+    Record the fingerprint and the number of rows of the loaded tables in
+    the manifest.
+    """
+    for table_name, fingerprint in fingerprints.items():
+        cursor.execute(
+            f"""
+            INSERT INTO {MANIFEST_TABLE}
+                (table_name, file_name, file_size, file_mtime_ns,
+                 file_hash, load_options, row_count)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (table_name) DO UPDATE
+                SET file_name = EXCLUDED.file_name,
+                    file_size = EXCLUDED.file_size,
+                    file_mtime_ns = EXCLUDED.file_mtime_ns,
+                    file_hash = EXCLUDED.file_hash,
+                    load_options = EXCLUDED.load_options,
+                    row_count = EXCLUDED.row_count,
+                    loaded_at = now();
+            """,
+            (table_name, *fingerprint, rows[table_name])
+        )
+
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Create a table for each CSV file of the customer "
+                    "directory."
+    )
+    parser.add_argument(
+        "--parallel",
+        action="store_true",
+        help="load the files concurrently, each on its own connection, and "
+             "swap the tables in only when all the loads succeeded"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="maximum number of files loaded at the same time with "
+             "--parallel (default: 4)"
+    )
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="copy the files in unlogged staging tables, then build the "
+             "indexes, analyze and swap the tables in"
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=f"only load the files which are new or were modified since "
+             f"they were recorded in the {MANIFEST_TABLE} table"
+    )
+    parser.add_argument(
+        "--stdin",
+        metavar="DIRECTORY",
+        nargs="?",
+        const="../../subject/customer",
+        help="stream the local CSV files of DIRECTORY (optionally .gz or "
+             ".zst compressed) with COPY FROM STDIN instead of reading them "
+             "from the docker container (default DIRECTORY: %(const)s)"
+    )
+    columns.add_arguments(parser)
+    arguments = parser.parse_args()
+    if arguments.workers < 1:
+        parser.error("--workers must be at least 1")
+    return arguments
+
+
+def main():
+
+    arguments = parse_arguments()
+
+    # Each worker of --parallel borrows its own connection from the pool.
+    database.get_pool(max_connections=arguments.workers + 1)
+
+    stdin = arguments.stdin is not None
+    local_dirpath = arguments.stdin if stdin else "../../subject/customer"
+    if stdin:
+        filenames = get_files_list(local_dirpath, STDIN_EXTENSIONS)
+        file_paths = [os.path.join(local_dirpath, file) for file in filenames]
+    else:
+        data_dirpath_on_container = "/subject/customer/"
+        filenames = get_files_list(local_dirpath)
+        file_paths = [data_dirpath_on_container + file for file in filenames]
+    table_names = [get_table_name(file) for file in filenames]
+
+    column_types = columns.get_column_types(
+        arguments.compact, arguments.price_type
+    )
+
+    if arguments.incremental:
+        with database.get_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(create_manifest_query())
+            fingerprints = select_files_to_load(
+                cursor,
+                table_names,
+                [os.path.join(local_dirpath, file) for file in filenames],
+                get_load_options(arguments.bulk, column_types)
+            )
+            connection.commit()
+            cursor.close()
+        file_paths = [
+            file_path
+            for table_name, file_path in zip(table_names, file_paths)
+            if table_name in fingerprints
+        ]
+        table_names = [
+            table_name for table_name in table_names
+            if table_name in fingerprints
+        ]
+        if len(table_names) == 0:
+            print("All the tables are up to date.")
+            return
+
+    if arguments.compact:
+        # Created once before the loads, which all use it.
+        with database.get_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(columns.create_enum_query())
+            connection.commit()
+            cursor.close()
+
+    if arguments.parallel or arguments.bulk:
+        rows = load_files(
+            table_names,
+            file_paths,
+            workers=arguments.workers if arguments.parallel else 1,
+            stdin=stdin,
+            bulk=arguments.bulk,
+            column_types=column_types
+        )
+    else:
+        rows = load_files_serially(
+            table_names, file_paths, stdin, column_types
+        )
+
+    if arguments.incremental:
+        with database.get_connection() as connection:
+            cursor = connection.cursor()
+            update_manifest(cursor, fingerprints, rows)
+            connection.commit()
+            cursor.close()
 
 
 if __name__ == "__main__":
@@ -11,40 +11,25 @@
 # *************************************************************************** #
 
 import os
-from dotenv import load_dotenv
-import psycopg2
+import sys
+import argparse
 
-
-def load_env(dotenv_path: str) -> tuple:
-    """
-    Load the postgresql config from the .env_postgres file.
-    Return a tuple with the config.
-    """
-    env_file_loaded = load_dotenv(dotenv_path)
-    if env_file_loaded is False:
-        raise FileNotFoundError(
-            "The .env_postgres file is missing or is empty."
-        )
-    environment_variables = (
-        os.getenv('POSTGRES_HOST'),
-        os.getenv('POSTGRES_DB'),
-        os.getenv('POSTGRES_USER'),
-        os.getenv('POSTGRES_PASSWORD'),
-        os.getenv('POSTGRES_PORT')
-    )
-    if any(variable is None for variable in environment_variables):
-        raise ValueError(
-            "One or more config variables are missing.\n" +
-            "Please check the .env_postgres file."
-        )
-    return environment_variables
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+)
+from common import database, csv_copy  # noqa: E402
 
 
-def create_query(table_name: str, path: str) -> str:
+def create_query(table_name: str, path: str | None) -> str:
     """
     Create table 'table_name' with the data from the CSV file 'path' in the
     docker container and copy the data from the CSV file to the table.
+    If 'path' is None, only the table is created.
     """
+    copy_statement = (
+        f"COPY {table_name} FROM '{path}' CSV HEADER;"
+        if path is not None else ""
+    )
     query = (
         f"""
         CREATE TABLE IF NOT EXISTS {table_name}
@@ -54,37 +39,48 @@ def create_query(table_name: str, path: str) -> str:
             category_code   VARCHAR(255),
             brand           VARCHAR(255)
         );
-        COPY {table_name} FROM '{path}' CSV HEADER;
+        {copy_statement}
         """
     )
     print(query)
     return query
 
 
-def main():
-
-    (host, database, username, password, port) = load_env(
-        "../../postgresql_docker/.env_postgres"
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Create the items table from its CSV file."
     )
-
-    connection = psycopg2.connect(
-        host=host,
-        database=database,
-        user=username,
-        password=password,
-        port=port
+    parser.add_argument(
+        "--stdin",
+        metavar="PATH",
+        nargs="?",
+        const="../../subject/item/item.csv",
+        help="stream the local CSV file PATH (optionally .gz or .zst "
+             "compressed) with COPY FROM STDIN instead of reading it from "
+             "the docker container (default PATH: %(const)s)"
     )
+    return parser.parse_args()
+
+
+def main():
+
+    arguments = parse_arguments()
 
     query: str = create_query(
         table_name="items",
-        path="/subject/item/item.csv"
+        path=None if arguments.stdin else "/subject/item/item.csv"
     )
 
-    cursor = connection.cursor()
-    cursor.execute(query)
-    connection.commit()
-    cursor.close()
-    connection.close()
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(query)
+        if arguments.stdin:
+            csv_copy.copy_from_stdin(cursor, "items", arguments.stdin)
+        connection.commit()
+        cursor.close()
 
 
 if __name__ == "__main__":
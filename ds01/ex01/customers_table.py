@@ -11,37 +11,24 @@
 # *************************************************************************** #
 
 import os
-from dotenv import load_dotenv
+import sys
+import argparse
 import psycopg2
 
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+)
+from common import database, columns  # noqa: E402
+
 
 # You have to join all the data_202*_*** tables together
 # in a table called "customers"
 
 
-def load_env(dotenv_path: str) -> tuple:
-    """
-    Load the postgresql config from the .env_postgres file.
-    Return a tuple with the config.
-    """
-    env_file_loaded = load_dotenv(dotenv_path)
-    if env_file_loaded is False:
-        raise FileNotFoundError(
-            "The .env_postgres file is missing or is empty."
-        )
-    environment_variables = (
-        os.getenv('POSTGRES_HOST'),
-        os.getenv('POSTGRES_DB'),
-        os.getenv('POSTGRES_USER'),
-        os.getenv('POSTGRES_PASSWORD'),
-        os.getenv('POSTGRES_PORT')
-    )
-    if any(variable is None for variable in environment_variables):
-        raise ValueError(
-            "One or more config variables are missing.\n" +
-            f"Please check the {dotenv_path} file."
-        )
-    return environment_variables
+MONTHS = (
+    "jan", "feb", "mar", "apr", "may", "jun",
+    "jul", "aug", "sep", "oct", "nov", "dec"
+)
 
 
 def match_pattern(table_name: str) -> bool:
@@ -58,10 +45,78 @@ def match_pattern(table_name: str) -> bool:
         return False
 
 
-def create_query(cursor: psycopg2.extensions.cursor) -> str:
+def get_partition_bounds(table_name: str) -> tuple[str, str]:
+    """
+    Return the first instant of the month of the table 'table_name'
+    (data_<year>_<month>) and the first instant of the next month.
+    """
+    year = int(table_name[5:9])
+    month = MONTHS.index(table_name[-3:]) + 1
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return (
+        f"{year}-{month:02d}-01 00:00:00+00",
+        f"{next_year}-{next_month:02d}-01 00:00:00+00"
+    )
+
+
+def check_same_column_types(
+    cursor: psycopg2.extensions.cursor,
+    table_names: list[str]
+) -> None:
+    """
+    Raise a ValueError if the tables 'table_names' do not all have the
+    same column types, some of them being loaded with --compact and the
+    others without it: neither UNION ALL nor ATTACH PARTITION accept
+    mixed layouts.
+    """
+    layouts = {}
+    for table_name in table_names:
+        column_types = columns.get_table_column_types(cursor, table_name)
+        layout = ", ".join(
+            f"{column} {column_type}"
+            for column, column_type in column_types.items()
+        )
+        layouts.setdefault(layout, []).append(table_name)
+    if len(layouts) > 1:
+        raise ValueError(
+            "The data_202*_*** tables do not have the same column types ("
+            + "; ".join(
+                f"{', '.join(names)}: {layout}"
+                for layout, names in layouts.items()
+            )
+            + "), reload them with the same --compact and --price-type "
+            "options."
+        )
+
+
+def create_detach_query(cursor: psycopg2.extensions.cursor) -> str:
+    """
+    Create a query to detach the partitions of the "customers" table, if
+    it is partitioned, so dropping it does not drop the data_202*_***
+    tables attached to it.
+    """
+    return "".join(
+        f"""
+        ALTER TABLE customers DETACH PARTITION {partition};"""
+        for partition in database.get_partitions(cursor, "customers")
+    )
+
+
+def create_query(
+    cursor: psycopg2.extensions.cursor,
+    partitioned: bool = False
+) -> str:
     """
     Create a query to create a table named "customers" with all the data
     from the tables matching the pattern data_202*_***.
+    If 'partitioned', "customers" is a table partitioned by month of
+    event_time and the data_202*_*** tables are attached to it as its
+    partitions, so no row is copied.
+    The data_202*_*** tables are then the storage of "customers": the
+    duplicates removed by ds01/ex02 and the columns fused by ds01/ex03 are
+    removed from and added to them. Reloading a month with
+    ds00/ex03/automatic_table.py detaches its table, so "customers" does
+    not hold this month anymore until this script is run again.
     """
 
     # Retrieve the table names from the database.
@@ -83,6 +138,34 @@ def create_query(cursor: psycopg2.extensions.cursor) -> str:
     ]
     if len(table_names) == 0:
         raise ValueError("There are no tables matching the pattern.")
+    check_same_column_types(cursor, table_names)
+
+    detach_statement = create_detach_query(cursor)
+
+    # The customers view on the star schema is replaced by the table.
+    drop_statement = (
+        "DROP VIEW customers;" if database.is_view(cursor, "customers")
+        else "DROP TABLE IF EXISTS customers;"
+    )
+
+    if partitioned:
+        attach_statement = "".join(
+            """
+        ALTER TABLE customers ATTACH PARTITION {}
+            FOR VALUES FROM ('{}') TO ('{}');""".format(
+                table_name, *get_partition_bounds(table_name)
+            )
+            for table_name in table_names
+        )
+        query = (
+            f"""{detach_statement}
+        {drop_statement}
+        CREATE TABLE customers (LIKE {table_names[0]})
+            PARTITION BY RANGE (event_time);{attach_statement}
+        """
+        )
+        print(query)
+        return query
 
     select_statement = (
         """
@@ -95,8 +178,8 @@ def create_query(cursor: psycopg2.extensions.cursor) -> str:
     )
 
     query = (
-        f"""
-        DROP TABLE IF EXISTS customers;
+        f"""{detach_statement}
+        {drop_statement}
         CREATE TABLE customers AS
         (
             {select_statement}
@@ -135,26 +218,35 @@ def create_query(cursor: psycopg2.extensions.cursor) -> str:
     return query
 
 
-def main():
-
-    (host, database, username, password, port) = load_env(
-        "../../postgresql_docker/.env_postgres"
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Join the data_202*_*** tables in the customers table."
     )
-
-    connection = psycopg2.connect(
-        host=host,
-        database=database,
-        user=username,
-        password=password,
-        port=port
+    parser.add_argument(
+        "--partitioned",
+        action="store_true",
+        help="attach the data_202*_*** tables as the monthly partitions of "
+             "customers instead of copying their rows: the data_202*_*** "
+             "tables are then modified by the ds01 scripts run on "
+             "customers, and a month reloaded by automatic_table.py is "
+             "detached from customers"
     )
+    return parser.parse_args()
+
+
+def main():
+
+    arguments = parse_arguments()
 
-    cursor = connection.cursor()
-    query: str = create_query(cursor)
-    cursor.execute(query)
-    connection.commit()
-    cursor.close()
-    connection.close()
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        query: str = create_query(cursor, arguments.partitioned)
+        cursor.execute(query)
+        connection.commit()
+        cursor.close()
 
 
 if __name__ == "__main__":
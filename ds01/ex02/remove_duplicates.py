@@ -11,39 +11,24 @@
 # *************************************************************************** #
 
 import os
-from dotenv import load_dotenv
+import sys
+import time
+import argparse
+from datetime import timedelta
 import psycopg2
 
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+)
+from common import database  # noqa: E402
+
+BATCH_INDEX = "customers_event_time_batch_idx"
+
 # You must delete the duplicate rows in the "customers" table.
 # Warning : Sometimes the server sends the same instruction
 #           with 1 second interval
 
 
-def load_env(dotenv_path: str) -> tuple:
-    """
-    Load the postgresql config from the .env_postgres file.
-    Return a tuple with the config.
-    """
-    env_file_loaded = load_dotenv(dotenv_path)
-    if env_file_loaded is False:
-        raise FileNotFoundError(
-            "The .env_postgres file is missing or is empty."
-        )
-    environment_variables = (
-        os.getenv('POSTGRES_HOST'),
-        os.getenv('POSTGRES_DB'),
-        os.getenv('POSTGRES_USER'),
-        os.getenv('POSTGRES_PASSWORD'),
-        os.getenv('POSTGRES_PORT')
-    )
-    if any(variable is None for variable in environment_variables):
-        raise ValueError(
-            "One or more config variables are missing.\n" +
-            f"Please check the {dotenv_path} file."
-        )
-    return environment_variables
-
-
 def create_query() -> str:
     """
     Create a query to delete the duplicate rows in the "customers" table.
@@ -79,27 +64,250 @@ def create_query() -> str:
     return query
 
 
-def main():
+def create_in_place_query(condition: str) -> str:
+    """
+    Create a query to delete, among the rows of the "customers" table
+    matching 'condition', every copy of a row but the first one.
+    The copies are found by ranking the rows of each group of identical
+    rows by their physical location (ctid, with the tableoid in case
+    "customers" is partitioned), so the table is never copied.
+    'condition' filters the deleted rows as well, so that both the outer
+    DELETE and the ranking subquery only read the batch through the
+    event_time index instead of scanning the whole table.
+    """
+    query = (
+        f"""
+        DELETE FROM customers
+            WHERE {condition}
+            AND (tableoid, ctid) IN (
+                SELECT tableoid, ctid
+                FROM (
+                    SELECT tableoid,
+                           ctid,
+                           ROW_NUMBER() OVER (
+                               PARTITION BY event_time,
+                                            event_type,
+                                            product_id,
+                                            price,
+                                            user_id,
+                                            user_session
+                               ORDER BY tableoid, ctid
+                           ) AS occurrence
+                    FROM customers
+                    WHERE {condition}
+                ) AS ranked_customers
+                WHERE occurrence > 1
+            );
+        """
+    )
+    return query
+
 
-    (host, database, username, password, port) = load_env(
-        "../../postgresql_docker/.env_postgres"
+def remove_duplicates_in_place(
+    connection: psycopg2.extensions.connection,
+    batch_days: int
+) -> None:
+    """
+    Delete the duplicate rows of the "customers" table in place, in
+    batches of 'batch_days' days of event_time, committing after each
+    batch.
+    Duplicate rows share the same event_time, so they always fall in the
+    same batch.
+    Unlike create_query, the table is never copied and each batch only
+    locks the rows it deletes for a short transaction.
+    The table built by ds01/ex01 has no index on event_time, so without
+    one every batch would scan the whole table twice. An index on
+    event_time is therefore built first, which costs a single scan and
+    sort of the table, and dropped once every batch is done: each batch
+    then only reads its own rows.
+    """
+    cursor = connection.cursor()
+    start_time = time.perf_counter()
+    index_query = (
+        f"CREATE INDEX IF NOT EXISTS {BATCH_INDEX} ON customers (event_time);"
     )
+    print(index_query)
+    cursor.execute(index_query)
+    connection.commit()
+    print(f"Index built in {time.perf_counter() - start_time:.1f}s")
+
+    cursor.execute("SELECT MIN(event_time), MAX(event_time) FROM customers;")
+    first_event_time, last_event_time = cursor.fetchone()
+
+    range_condition = "event_time >= %(start)s AND event_time < %(end)s"
+    batches = []
+    if first_event_time is not None:
+        start = first_event_time
+        while start <= last_event_time:
+            end = start + timedelta(days=batch_days)
+            batches.append((range_condition, {"start": start, "end": end}))
+            start = end
+    batches.append(("event_time IS NULL", {}))
+
+    print(create_in_place_query(range_condition))
+    start_time = time.perf_counter()
+    deleted = 0
+    for index, (condition, bounds) in enumerate(batches, start=1):
+        cursor.execute(create_in_place_query(condition), bounds)
+        connection.commit()
+        deleted += cursor.rowcount
+        batch = (
+            f"[{bounds['start']}, {bounds['end']})" if bounds
+            else "with a NULL event_time"
+        )
+        print(
+            f"Batch {index}/{len(batches)} {batch}: " +
+            f"{cursor.rowcount:_} duplicates deleted, {deleted:_} in " +
+            f"total after {time.perf_counter() - start_time:.1f}s"
+        )
+
+    cursor.execute(f"DROP INDEX IF EXISTS {BATCH_INDEX};")
+    connection.commit()
+    cursor.close()
+    vacuum_customers(connection)
 
-    connection = psycopg2.connect(
-        host=host,
-        database=database,
-        user=username,
-        password=password,
-        port=port
+
+def create_near_duplicates_query() -> str:
+    """
+    Create a query to delete the rows of the "customers" table which
+    repeat the previous event of the same user, session, product, type
+    and price within the interval passed as the query parameter, the
+    server sometimes sending the same instruction again a second later.
+    The events of each group are compared with LAG in a single pass over
+    the table sorted by group and event_time, instead of a self join.
+    Exact duplicates are 0 seconds apart, so they are deleted as well.
+    In a chain of events, each one is compared with the one right before
+    it, even if this one is deleted too.
+    """
+    query = (
+        """
+        DELETE FROM customers
+            WHERE (tableoid, ctid) IN (
+                SELECT tableoid, ctid
+                FROM (
+                    SELECT tableoid,
+                           ctid,
+                           event_time,
+                           LAG(event_time) OVER (
+                               PARTITION BY event_type,
+                                            product_id,
+                                            user_id,
+                                            user_session,
+                                            price
+                               ORDER BY event_time, tableoid, ctid
+                           ) AS previous_event_time
+                    FROM customers
+                ) AS sorted_customers
+                WHERE event_time - previous_event_time <= %s
+            );
+        """
     )
+    print(query)
+    return query
 
-    query: str = create_query()
 
+def remove_near_duplicates(
+    connection: psycopg2.extensions.connection,
+    tolerance: float
+) -> None:
+    """
+    Delete the rows of the "customers" table repeating the previous
+    identical event at most 'tolerance' seconds later.
+    """
+    start_time = time.perf_counter()
     cursor = connection.cursor()
-    cursor.execute(query)
+    cursor.execute(
+        create_near_duplicates_query(),
+        (timedelta(seconds=tolerance),)
+    )
     connection.commit()
+    print(
+        f"{cursor.rowcount:_} near duplicates deleted in " +
+        f"{time.perf_counter() - start_time:.1f}s"
+    )
     cursor.close()
-    connection.close()
+    vacuum_customers(connection)
+
+
+def vacuum_customers(connection: psycopg2.extensions.connection) -> None:
+    """
+    Make the space of the deleted rows reusable and refresh the planner
+    statistics of the "customers" table.
+    VACUUM cannot run inside a transaction.
+    """
+    cursor = connection.cursor()
+    connection.autocommit = True
+    cursor.execute("VACUUM ANALYZE customers;")
+    connection.autocommit = False
+    cursor.close()
+
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Delete the duplicate rows of the customers table."
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--in-place",
+        action="store_true",
+        help="delete the duplicates in place, batch by batch, instead of "
+             "rebuilding the whole table in a single transaction"
+    )
+    parser.add_argument(
+        "--batch-days",
+        type=int,
+        help="number of days of event_time processed per batch with "
+             "--in-place (default: 7)"
+    )
+    mode.add_argument(
+        "--tolerance",
+        type=float,
+        metavar="SECONDS",
+        help="also delete the events repeating the previous identical "
+             "event at most SECONDS later, in a single pass over the "
+             "whole table"
+    )
+    arguments = parser.parse_args()
+    if arguments.batch_days is not None and arguments.tolerance is not None:
+        parser.error("--batch-days is not allowed with --tolerance")
+    if arguments.batch_days is not None and not arguments.in_place:
+        parser.error("--batch-days requires --in-place")
+    if arguments.batch_days is None:
+        arguments.batch_days = 7
+    if arguments.batch_days < 1:
+        parser.error("--batch-days must be at least 1")
+    if arguments.tolerance is not None and arguments.tolerance < 0:
+        parser.error("--tolerance must be non-negative")
+    return arguments
+
+
+def main():
+
+    arguments = parse_arguments()
+
+    with database.get_connection() as connection:
+
+        cursor = connection.cursor()
+        database.check_not_view(cursor, "customers")
+        cursor.close()
+
+        if arguments.tolerance is not None:
+            remove_near_duplicates(connection, arguments.tolerance)
+            return
+
+        if arguments.in_place:
+            remove_duplicates_in_place(connection, arguments.batch_days)
+            return
+
+        query: str = create_query()
+
+        cursor = connection.cursor()
+        cursor.execute(query)
+        connection.commit()
+        cursor.close()
 
 
 if __name__ == "__main__":
@@ -11,66 +11,141 @@
 # *************************************************************************** #
 
 import os
+import sys
+import resource
 import pandas
 import sqlalchemy
-from dotenv import load_dotenv
 
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+)
+from common import database  # noqa: E402
 
-def load_env(dotenv_path: str) -> tuple:
+
+# Compact dtypes of the columns of the "customers" table.
+CUSTOMERS_DTYPES = {
+    "event_type": pandas.CategoricalDtype(
+        ["view", "cart", "remove_from_cart", "purchase"]
+    ),
+    "product_id": "int32",
+    "price": "float32",
+}
+
+
+def get_peak_memory() -> int:
     """
-    Load the postgresql config from the .env_postgres file.
-    Return a tuple with the config.
+    Return the peak resident memory of the process in bytes.
     """
-    env_file_loaded = load_dotenv(dotenv_path)
-    if env_file_loaded is False:
-        raise FileNotFoundError(
-            "The .env_postgres file is missing or is empty."
-        )
-    environment_variables = (
-        os.getenv('POSTGRES_HOST'),
-        os.getenv('POSTGRES_DB'),
-        os.getenv('POSTGRES_USER'),
-        os.getenv('POSTGRES_PASSWORD'),
-        os.getenv('POSTGRES_PORT')
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS.
+    return peak_memory if sys.platform == "darwin" else peak_memory * 1024
+
+
+def print_memory_report(customers: pandas.DataFrame) -> None:
+    """
+    Print the memory used by the dataframe and the peak memory of the
+    process while loading it.
+    """
+    print(
+        f"Customers dataframe: {len(customers):_} rows, " +
+        f"{customers.memory_usage(deep=True).sum() / 2**20:_.0f} MiB, " +
+        f"peak memory {get_peak_memory() / 2**20:_.0f} MiB"
     )
-    if any(variable is None for variable in environment_variables):
-        raise ValueError(
-            "One or more config variables are missing.\n" +
-            f"Please check the {dotenv_path} file."
-        )
-    return environment_variables
 
 
-def get_customers() -> pandas.DataFrame:
+def write_cache(customers: pandas.DataFrame, cache_path: str) -> None:
     """
-    Return all the rows in the "customers" table.
+    Write the customers dataframe to a Parquet dataset with one directory
+    per month (month=YYYYMM).
+    Within each month, the rows are sorted by event_type and event_time
+    so the min/max statistics of the row groups let the readers skip the
+    row groups of the other event types.
+    """
+    event_time = customers["event_time"]
+    customers.assign(
+        month=event_time.dt.year * 100 + event_time.dt.month
+    ).sort_values(
+        by=["month", "event_type", "event_time"]
+    ).to_parquet(
+        cache_path,
+        partition_cols=["month"],
+        index=False
+    )
+
+
+def read_cache(
+    cache_path: str,
+    columns: list[str] | None = None,
+    filters: list[tuple] | None = None
+) -> pandas.DataFrame:
+    """
+    Read the customers Parquet dataset, keeping only the 'columns' and the
+    rows matching the pyarrow 'filters'.
+    Only the requested columns are read from disk, and the months and row
+    groups which cannot match the filters are skipped.
+    The month partition column is only returned if requested.
+    """
+    customers = pandas.read_parquet(
+        cache_path,
+        columns=columns,
+        filters=filters
+    )
+    if columns is None or "month" not in columns:
+        customers = customers.drop(columns="month", errors="ignore")
+    return customers
+
+
+def get_customers(
+    columns: list[str] | None = None,
+    filters: list[tuple] | None = None
+) -> pandas.DataFrame:
+    """
+    Return the rows in the "customers" table, restricted to the 'columns'
+    and the rows matching the pyarrow 'filters', e.g. the purchases only:
+
+        get_customers(
+            columns=["event_time", "user_id", "price"],
+            filters=[("event_type", "==", "purchase")]
+        )
+
+    The table is cached locally in a Parquet dataset partitioned by month
+    (see write_cache), so the next calls only read the requested columns
+    and the matching months and row groups.
+    The chunks read from the database are converted to compact dtypes and
+    concatenated once at the end, instead of copying the growing
+    dataframe after each chunk.
     """
     print("Loading customers table...")
 
-    csv_path = "customers.csv"
+    cache_path = "customers_parquet"
 
-    # If the csv file already exists, load it.
-    if os.path.isfile(csv_path):
-        customers = pandas.read_csv(csv_path)
+    # If the cache already exists, load it.
+    if os.path.isdir(cache_path):
+        customers = read_cache(cache_path, columns, filters)
+        print_memory_report(customers)
         return customers
 
     # Else load the "customers" table from the postgresql database.
-    (host, database, username, password, port) = load_env(
-        "../../postgresql_docker/.env_postgres"
-    )
+    (host, database_name, username, password, port) = database.load_env()
     connection = sqlalchemy.create_engine(
-        f"postgresql://{username}:{password}@{host}:{port}/{database}"
+        f"postgresql://{username}:{password}@{host}:{port}/{database_name}"
     )
-    customers = pandas.DataFrame()
+    chunks = []
     for chunk in pandas.read_sql_table(
         "customers",
         connection,
         chunksize=1_000_000
     ):
-        customers = pandas.concat([customers, chunk])
+        chunks.append(chunk.astype(CUSTOMERS_DTYPES))
         print("1_000_000 lines loaded in the Dataframe...")
-    customers.to_csv(csv_path, index=False)
+    customers = pandas.concat(chunks, ignore_index=True)
+    del chunks
     connection.dispose()
+    write_cache(customers, cache_path)
+    if columns is not None or filters is not None:
+        del customers
+        customers = read_cache(cache_path, columns, filters)
+    print_memory_report(customers)
     return customers
 
 
@@ -12,33 +12,37 @@
 
 
 import os
-from dotenv import load_dotenv
-import psycopg2
+import sys
+import time
+import argparse
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+)
+from common import database  # noqa: E402
 
-def load_env(dotenv_path: str) -> tuple:
-    """
-    Load the postgresql config from the .env_postgres file.
-    Return a tuple with the config.
-    """
-    env_file_loaded = load_dotenv(dotenv_path)
-    if env_file_loaded is False:
-        raise FileNotFoundError(
-            "The .env_postgres file is missing or is empty."
-        )
-    environment_variables = (
-        os.getenv('POSTGRES_HOST'),
-        os.getenv('POSTGRES_DB'),
-        os.getenv('POSTGRES_USER'),
-        os.getenv('POSTGRES_PASSWORD'),
-        os.getenv('POSTGRES_PORT')
-    )
-    if any(variable is None for variable in environment_variables):
-        raise ValueError(
-            "One or more config variables are missing.\n" +
-            f"Please check the {dotenv_path} file."
-        )
-    return environment_variables
+# Columns of the customers table after the fusion, from customers joined
+# with unique_items.
+FUSED_SELECT = """
+            SELECT
+                customers.event_time,
+                customers.event_type,
+                customers.product_id,
+                customers.price,
+                customers.user_id,
+                customers.user_session,
+                unique_items.category_id,
+                unique_items.category_code,
+                unique_items.brand
+            FROM customers
+            LEFT JOIN unique_items
+                ON unique_items.product_id = customers.product_id"""
+
+# Prefix of the chunk tables of the parallel fusion, the partitions of
+# customers_fused.
+CHUNK_PREFIX = "customers_fused_"
 
 
 def create_query() -> str:
@@ -70,27 +74,315 @@ def create_query() -> str:
     return query
 
 
-def main():
+def create_unique_items_query() -> str:
+    """
+    Create the "unique_items" table, with one row per product_id of the
+    "items" table, indexed by its primary key to be joined with customers.
+    """
+
+    query = (
+        """
+        DROP TABLE IF EXISTS unique_items;
+        CREATE TABLE unique_items AS
+            SELECT  product_id,
+                    MAX(category_id) AS category_id,
+                    MAX(category_code) AS category_code,
+                    MAX(brand) AS brand
+            FROM items
+            WHERE product_id IS NOT NULL
+            GROUP BY product_id;
+        ALTER TABLE unique_items ADD PRIMARY KEY (product_id);
+        ANALYZE unique_items;
+        """
+    )
+    print(query)
+    return query
+
+
+def create_ctas_query() -> str:
+    """
+    Create a query building a new customers table, with the columns of the
+    items, in a single pass over customers joined with unique_items.
+    Unlike the UPDATE of create_query, no row is rewritten, so the new
+    table has no dead tuples to vacuum.
+    The columns are listed so the query also works on a customers table
+    already fused.
+    """
+
+    query = (
+        f"""
+        DROP TABLE IF EXISTS customers_fused;
+        CREATE TABLE customers_fused AS{FUSED_SELECT};
+        """
+    )
+    print(query)
+    return query
+
+
+def create_swap_query(cursor, chunks: list[str] = ()) -> str:
+    """
+    Create a query replacing the customers table by customers_fused, and
+    renaming its partitions 'chunks' from customers_fused_* to
+    customers_*.
+    If customers is partitioned, the partitions created by a previous
+    parallel fusion (customers_*) are dropped with it, and the other ones,
+    the data_202*_*** tables, are detached first so they are kept.
+    The indexes of the old customers table are not copied.
+    """
 
-    (host, database, username, password, port) = load_env(
-        "../../postgresql_docker/.env_postgres"
+    detach_statement = "".join(
+        f"""
+        ALTER TABLE customers DETACH PARTITION {partition};"""
+        for partition in database.get_partitions(cursor, "customers")
+        if not partition.startswith("customers_")
+    )
+    rename_statement = "".join(
+        f"""
+        ALTER TABLE {chunk}
+            RENAME TO customers_{chunk.removeprefix(CHUNK_PREFIX)};"""
+        for chunk in chunks
     )
 
-    connection = psycopg2.connect(
-        host=host,
-        database=database,
-        user=username,
-        password=password,
-        port=port
+    query = (
+        f"""{detach_statement}
+        DROP TABLE customers;
+        ALTER TABLE customers_fused RENAME TO customers;{rename_statement}
+        ANALYZE customers;
+        """
     )
+    print(query)
+    return query
+
+
+def get_month_bounds(cursor) -> list[tuple[datetime, datetime]]:
+    """
+    Return the first instant, in UTC, of each month of event_time in the
+    customers table, and of the next month.
+    """
+    cursor.execute("SELECT MIN(event_time), MAX(event_time) FROM customers;")
+    first, last = cursor.fetchone()
+    if first is None:
+        return []
+    first = first.astimezone(timezone.utc)
+    last = last.astimezone(timezone.utc)
+    month = datetime(first.year, first.month, 1, tzinfo=timezone.utc)
+    bounds = []
+    while month <= last:
+        if month.month == 12:
+            next_month = month.replace(year=month.year + 1, month=1)
+        else:
+            next_month = month.replace(month=month.month + 1)
+        bounds.append((month, next_month))
+        month = next_month
+    return bounds
+
+
+def create_parent_query() -> str:
+    """
+    Create the customers_fused table, partitioned by month of event_time,
+    with the columns and types of the fused customers.
+    """
+
+    query = (
+        f"""
+        DROP TABLE IF EXISTS customers_fused;
+        CREATE TEMP TABLE customers_fused_columns ON COMMIT DROP AS
+            {FUSED_SELECT.strip()}
+            WITH NO DATA;
+        CREATE TABLE customers_fused (LIKE customers_fused_columns)
+            PARTITION BY RANGE (event_time);
+        """
+    )
+    print(query)
+    return query
+
+
+def create_chunk_query(chunk: str, bounds: tuple | None) -> str:
+    """
+    Create the chunk table of the fused customers of the month 'bounds', or
+    of the customers without event_time if 'bounds' is None, and attach it
+    as a partition of customers_fused.
+    The CHECK constraint matching the partition bounds is added before
+    attaching it, so PostgreSQL does not scan the chunk again to validate
+    it.
+    """
+
+    if bounds is None:
+        condition = "customers.event_time IS NULL"
+        check = "event_time IS NULL"
+        partition_bounds = "DEFAULT"
+    else:
+        start, end = (f"{bound:%Y-%m-%d %H:%M:%S}+00" for bound in bounds)
+        condition = (
+            f"customers.event_time >= '{start}' "
+            f"AND customers.event_time < '{end}'"
+        )
+        check = (
+            f"event_time IS NOT NULL "
+            f"AND event_time >= '{start}' AND event_time < '{end}'"
+        )
+        partition_bounds = f"FOR VALUES FROM ('{start}') TO ('{end}')"
+
+    query = (
+        f"""
+        DROP TABLE IF EXISTS {chunk};
+        CREATE TABLE {chunk} AS{FUSED_SELECT}
+            WHERE {condition};
+        ALTER TABLE {chunk} ADD CONSTRAINT {chunk}_bounds CHECK ({check});
+        ALTER TABLE customers_fused ATTACH PARTITION {chunk}
+            {partition_bounds};
+        """
+    )
+    return query
+
+
+def fuse_chunk(chunk: str, bounds: tuple | None) -> float:
+    """
+    Create and attach the chunk on its own pooled connection.
+    Return the elapsed time in seconds.
+    """
+    start = time.perf_counter()
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(create_chunk_query(chunk, bounds))
+        connection.commit()
+        cursor.close()
+    return time.perf_counter() - start
+
+
+def print_progress(done: int, total: int) -> None:
+
+    width = 40
+    filled = width * done // total
+    print(f"[{'#' * filled}{' ' * (width - filled)}] {done}/{total} chunks")
+
+
+def fuse_in_parallel(workers: int) -> None:
+    """
+    Build customers_fused one month at a time, each month in its own chunk
+    table created on its own pooled connection, with at most 'workers'
+    chunks built at the same time, then swap it in place of customers.
+    The chunks already attached to customers_fused by a previous run are
+    kept, so a failed run can be resumed where it stopped. customers is
+    only replaced once all the chunks are attached, otherwise the first
+    error is raised.
+    """
+    start = time.perf_counter()
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT to_regclass('customers_fused') IS NOT NULL;")
+        if cursor.fetchone()[0]:
+            print("Resuming the fusion in customers_fused.")
+        else:
+            cursor.execute(create_unique_items_query())
+            cursor.execute(create_parent_query())
+        connection.commit()
+
+        chunks = {f"{CHUNK_PREFIX}default": None}
+        for bounds in get_month_bounds(cursor):
+            chunks[f"{CHUNK_PREFIX}{bounds[0]:%Y_%m}"] = bounds
+        attached = set(database.get_partitions(cursor, "customers_fused"))
+        cursor.close()
+
+    todo = {
+        chunk: bounds for chunk, bounds in chunks.items()
+        if chunk not in attached
+    }
+    done = len(chunks) - len(todo)
+    if done > 0:
+        print(f"{done} chunks already attached.")
+    print_progress(done, len(chunks))
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(fuse_chunk, chunk, bounds): chunk
+            for chunk, bounds in todo.items()
+        }
+        for future in as_completed(futures):
+            chunk = futures[future]
+            try:
+                elapsed = future.result()
+            except Exception as error:
+                print(f"{chunk}: fusion failed: {error}")
+                errors.append(error)
+                continue
+            done += 1
+            print(f"{chunk}: fused in {elapsed:.2f}s")
+            print_progress(done, len(chunks))
+    if errors:
+        print("Run the fusion again to resume it.")
+        raise errors[0]
+
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(create_swap_query(cursor, list(chunks)))
+        connection.commit()
+        cursor.close()
+
+    print(
+        f"{len(chunks)} chunks fused in "
+        f"{time.perf_counter() - start:.2f}s with {workers} workers"
+    )
+
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Add the columns of the items table to the customers "
+                    "table."
+    )
+    parser.add_argument(
+        "--ctas",
+        action="store_true",
+        help="build a new customers table joined with the items instead "
+             "of updating every row of the existing one"
+    )
+    parser.add_argument(
+        "--parallel",
+        action="store_true",
+        help="same as --ctas, one month at a time on several connections, "
+             "resuming the previous run if it failed"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="number of months fused at the same time with --parallel "
+             "(default: %(default)s)"
+    )
+    arguments = parser.parse_args()
+    if arguments.workers < 1:
+        parser.error("--workers must be at least 1")
+    return arguments
+
+
+def main():
+
+    arguments = parse_arguments()
+
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        database.check_not_view(cursor, "customers")
+        cursor.close()
 
-    query: str = create_query()
+    if arguments.parallel:
+        database.get_pool(max_connections=arguments.workers + 1)
+        fuse_in_parallel(arguments.workers)
+        return
 
-    cursor = connection.cursor()
-    cursor.execute(query)
-    connection.commit()
-    cursor.close()
-    connection.close()
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        if arguments.ctas:
+            cursor.execute(create_unique_items_query())
+            cursor.execute(create_ctas_query())
+            cursor.execute(create_swap_query(cursor))
+        else:
+            cursor.execute(create_query())
+        connection.commit()
+        cursor.close()
 
 
 if __name__ == "__main__":
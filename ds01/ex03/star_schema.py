@@ -0,0 +1,304 @@
+# *************************************************************************** #
+#                                                                             #
+#                                                        :::      ::::::::    #
+#    star_schema.py                                    :+:      :+:    :+:    #
+#                                                    +:+ +:+         +:+      #
+#    By: cmariot <cmariot@student.42.fr>           +#+  +:+       +#+         #
+#                                                +#+#+#+#+#+   +#+            #
+#    Created: 2026/10/18 17:26:14 by cmariot          #+#    #+#              #
+#    Updated: 2026/10/18 17:26:14 by cmariot         ###   ########.fr        #
+#                                                                             #
+# *************************************************************************** #
+
+# Normalize the customers table in a star schema:
+# - fact_events: one row per event, with compact keys,
+# - dim_event_types, dim_products, dim_categories, dim_brands: the values
+#   repeated in each event of the customers table.
+# The customers table is replaced by a view with the same columns, so the
+# scripts reading it keep working. The scripts modifying it (ds01) need the
+# customers table back: restore it with --revert, or create it again from
+# the data_202*_*** tables with ds01/ex01/customers_table.py.
+
+import os
+import sys
+import argparse
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+)
+from common import database  # noqa: E402
+
+
+STAR_TABLES = (
+    "fact_events",
+    "dim_products",
+    "dim_categories",
+    "dim_brands",
+    "dim_event_types",
+)
+
+
+def create_dimensions_query() -> str:
+    """
+    Create the dimension tables from the customers and items tables.
+    Each product has the category and brand of the items table, like in
+    fusion.py, and the products without items have none.
+    """
+
+    query = (
+        """
+        DROP TABLE IF EXISTS fact_events, dim_products, dim_categories,
+                             dim_brands, dim_event_types;
+
+        CREATE TEMP TABLE star_items ON COMMIT DROP AS
+            SELECT  product_id,
+                    MAX(category_id) AS category_id,
+                    MAX(category_code) AS category_code,
+                    MAX(brand) AS brand
+            FROM items
+            WHERE product_id IS NOT NULL
+            GROUP BY product_id;
+
+        CREATE TABLE dim_event_types
+        (
+            event_type_id   SMALLINT PRIMARY KEY,
+            event_type      VARCHAR(32) UNIQUE NOT NULL
+        );
+        INSERT INTO dim_event_types (event_type_id, event_type)
+            SELECT ROW_NUMBER() OVER (ORDER BY event_type), event_type
+            FROM (
+                SELECT DISTINCT event_type::text AS event_type
+                FROM customers
+                WHERE event_type IS NOT NULL
+            ) AS event_types;
+
+        CREATE TABLE dim_brands
+        (
+            brand_id        INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+            brand           VARCHAR(255) UNIQUE NOT NULL
+        );
+        INSERT INTO dim_brands (brand)
+            SELECT DISTINCT brand
+            FROM star_items
+            WHERE brand IS NOT NULL
+            ORDER BY brand;
+
+        CREATE TABLE dim_categories
+        (
+            category_id     BIGINT PRIMARY KEY,
+            category_code   VARCHAR(255)
+        );
+        INSERT INTO dim_categories (category_id, category_code)
+            SELECT category_id, MAX(category_code)
+            FROM star_items
+            WHERE category_id IS NOT NULL
+            GROUP BY category_id;
+
+        CREATE TABLE dim_products
+        (
+            product_id      INTEGER PRIMARY KEY,
+            category_id     BIGINT REFERENCES dim_categories,
+            brand_id        INTEGER REFERENCES dim_brands
+        );
+        INSERT INTO dim_products (product_id, category_id, brand_id)
+            SELECT
+                products.product_id,
+                star_items.category_id,
+                dim_brands.brand_id
+            FROM (
+                SELECT product_id FROM star_items
+                UNION
+                SELECT DISTINCT product_id
+                FROM customers
+                WHERE product_id IS NOT NULL
+            ) AS products
+            LEFT JOIN star_items
+                ON star_items.product_id = products.product_id
+            LEFT JOIN dim_brands
+                ON dim_brands.brand = star_items.brand;
+        """
+    )
+    print(query)
+    return query
+
+
+def create_fact_query() -> str:
+    """
+    Create the fact_events table from the customers table: the event_type
+    replaced by its SMALLINT key, the user_session stored as a UUID, and
+    the columns of the items moved to the dimensions.
+    """
+
+    query = (
+        """
+        CREATE TABLE fact_events AS
+            SELECT
+                customers.event_time,
+                dim_event_types.event_type_id,
+                customers.product_id,
+                customers.price,
+                customers.user_id,
+                customers.user_session::uuid AS user_session
+            FROM customers
+            LEFT JOIN dim_event_types
+                ON dim_event_types.event_type = customers.event_type::text;
+        ALTER TABLE fact_events
+            ADD FOREIGN KEY (event_type_id) REFERENCES dim_event_types,
+            ADD FOREIGN KEY (product_id) REFERENCES dim_products;
+        """
+    )
+    print(query)
+    return query
+
+
+def create_view_query(cursor) -> str:
+    """
+    Replace the customers table by a view on the star schema with the same
+    columns as the customers table after fusion.py.
+    The dimensions are LEFT JOINed on their primary key, so PostgreSQL
+    removes the joins of the dimensions whose columns a query does not
+    use, and a query on event_type and price only reads fact_events and
+    dim_event_types.
+    If customers is partitioned, its partitions are detached first so
+    dropping it does not drop them.
+    """
+
+    detach_statement = "".join(
+        f"""
+        ALTER TABLE customers DETACH PARTITION {partition};"""
+        for partition in database.get_partitions(cursor, "customers")
+    )
+
+    query = (
+        f"""{detach_statement}
+        DROP TABLE customers;
+        CREATE VIEW customers AS
+            SELECT
+                fact_events.event_time,
+                dim_event_types.event_type,
+                fact_events.product_id,
+                fact_events.price,
+                fact_events.user_id,
+                fact_events.user_session::text AS user_session,
+                dim_products.category_id,
+                dim_categories.category_code,
+                dim_brands.brand
+            FROM fact_events
+            LEFT JOIN dim_event_types
+                ON dim_event_types.event_type_id = fact_events.event_type_id
+            LEFT JOIN dim_products
+                ON dim_products.product_id = fact_events.product_id
+            LEFT JOIN dim_categories
+                ON dim_categories.category_id = dim_products.category_id
+            LEFT JOIN dim_brands
+                ON dim_brands.brand_id = dim_products.brand_id;
+        """
+    )
+    print(query)
+    return query
+
+
+def create_revert_query() -> str:
+    """
+    Replace the customers view by a table with the same rows and columns,
+    and drop the star schema.
+    """
+
+    query = (
+        f"""
+        CREATE TABLE customers_flat AS
+            SELECT * FROM customers;
+        DROP VIEW customers;
+        ALTER TABLE customers_flat RENAME TO customers;
+        DROP TABLE {", ".join(STAR_TABLES)};
+        ANALYZE customers;
+        """
+    )
+    print(query)
+    return query
+
+
+def get_size(cursor, table_names) -> int:
+    """
+    Return the total size on disk, indexes included, of the tables.
+    """
+    cursor.execute(
+        """
+        SELECT COALESCE(SUM(pg_total_relation_size(table_name::regclass)), 0)
+        FROM unnest(%s::text[]) AS table_name;
+        """,
+        (list(table_names),)
+    )
+    return cursor.fetchone()[0]
+
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Normalize the customers table in a star schema."
+    )
+    parser.add_argument(
+        "--revert",
+        action="store_true",
+        help="restore the customers table from the star schema and drop "
+             "the star schema"
+    )
+    return parser.parse_args()
+
+
+def main():
+
+    arguments = parse_arguments()
+
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+
+        cursor.execute(
+            "SELECT relkind FROM pg_class WHERE relname = 'customers';"
+        )
+        relkind = cursor.fetchone()
+        if relkind is None:
+            raise ValueError("The customers table does not exist.")
+
+        if arguments.revert:
+            if relkind[0] != "v":
+                raise ValueError("customers is already a table.")
+            cursor.execute(create_revert_query())
+            connection.commit()
+            cursor.close()
+            return
+
+        if relkind[0] == "v":
+            raise ValueError(
+                "customers is already a view on the star schema, run "
+                "star_schema.py --revert first to normalize it again."
+            )
+        customers_size = get_size(
+            cursor,
+            ["customers", *database.get_partitions(cursor, "customers")]
+        )
+
+        cursor.execute(create_dimensions_query())
+        cursor.execute(create_fact_query())
+        cursor.execute(create_view_query(cursor))
+        connection.commit()
+
+        for table_name in STAR_TABLES:
+            cursor.execute(f"ANALYZE {table_name};")
+        connection.commit()
+
+        star_size = get_size(cursor, STAR_TABLES)
+        print(
+            f"customers: {customers_size:_} bytes, "
+            f"star schema: {star_size:_} bytes"
+        )
+        cursor.close()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as error:
+        print("Error:", error)
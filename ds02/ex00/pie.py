@@ -11,34 +11,14 @@
 # *************************************************************************** #
 
 import os
-from dotenv import load_dotenv
-import psycopg2
+import sys
+import argparse
 import matplotlib.pyplot as plt
 
-
-def load_env(dotenv_path: str) -> tuple:
-    """
-    Load the postgresql config from the .env_postgres file.
-    Return a tuple with the config.
-    """
-    env_file_loaded = load_dotenv(dotenv_path)
-    if env_file_loaded is False:
-        raise FileNotFoundError(
-            "The .env_postgres file is missing or is empty."
-        )
-    environment_variables = (
-        os.getenv('POSTGRES_HOST'),
-        os.getenv('POSTGRES_DB'),
-        os.getenv('POSTGRES_USER'),
-        os.getenv('POSTGRES_PASSWORD'),
-        os.getenv('POSTGRES_PORT')
-    )
-    if any(variable is None for variable in environment_variables):
-        raise ValueError(
-            "One or more config variables are missing.\n" +
-            "Please check the .env_postgres file."
-        )
-    return environment_variables
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+)
+from common import database  # noqa: E402
 
 
 def create_query() -> str:
@@ -62,25 +42,32 @@ def create_query() -> str:
     return query
 
 
-def fetch_data() -> list:
-    (host, database, username, password, port) = load_env(
-        "../../postgresql_docker/.env_postgres"
-    )
+def create_summary_query() -> str:
+    """
+    Same as create_query, from the summary_daily_events table refreshed by
+    common/summaries.py instead of the customers table.
+    """
 
-    connection = psycopg2.connect(
-        host=host,
-        database=database,
-        user=username,
-        password=password,
-        port=port
+    query = (
+        """
+        SELECT
+            event_type,
+            SUM(events)::bigint AS count
+        FROM summary_daily_events
+        GROUP BY event_type
+        ORDER BY count DESC;
+        """
     )
+    print(query)
+    return query
+
 
-    query = create_query()
-    cursor = connection.cursor()
-    cursor.execute(query)
-    data = cursor.fetchall()
-    cursor.close()
-    connection.close()
+def fetch_data(summaries: bool = False) -> list:
+    if summaries:
+        query = create_summary_query()
+    else:
+        query = create_query()
+    data = database.fetch_all(query)
 
     print("Data fetched from the database:", data)
     return data
@@ -104,8 +91,24 @@ def pie_plot(data: list) -> None:
     plt.show()
 
 
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Plot the proportion of each event_type."
+    )
+    parser.add_argument(
+        "--summaries",
+        action="store_true",
+        help="read the summary tables instead of the customers table"
+    )
+    return parser.parse_args()
+
+
 def main():
-    data = fetch_data()
+    arguments = parse_arguments()
+    data = fetch_data(arguments.summaries)
     pie_plot(data)
 
 
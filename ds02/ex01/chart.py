@@ -11,34 +11,20 @@
 # *************************************************************************** #
 
 import os
-from dotenv import load_dotenv
-import psycopg2
+import sys
+import argparse
+from collections.abc import Iterable
+import numpy
+import pandas
 import matplotlib.pyplot as plt
 
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+)
+from common import database  # noqa: E402
 
-def load_env(dotenv_path: str) -> tuple:
-    """
-    Load the postgresql config from the .env_postgres file.
-    Return a tuple with the config.
-    """
-    env_file_loaded = load_dotenv(dotenv_path)
-    if env_file_loaded is False:
-        raise FileNotFoundError(
-            "The .env_postgres file is missing or is empty."
-        )
-    environment_variables = (
-        os.getenv('POSTGRES_HOST'),
-        os.getenv('POSTGRES_DB'),
-        os.getenv('POSTGRES_USER'),
-        os.getenv('POSTGRES_PASSWORD'),
-        os.getenv('POSTGRES_PORT')
-    )
-    if any(variable is None for variable in environment_variables):
-        raise ValueError(
-            "One or more config variables are missing.\n" +
-            "Please check the .env_postgres file."
-        )
-    return environment_variables
+
+SECONDS_PER_DAY = 86_400
 
 
 def create_query() -> str:
@@ -56,7 +42,7 @@ def create_query() -> str:
         SELECT DISTINCT
             event_time,
             user_id,
-            price
+            price::double precision AS price
         FROM customers
         WHERE event_type = 'purchase'
         ORDER BY event_time ASC;
@@ -67,53 +53,182 @@ def create_query() -> str:
 
 
 def fetch_data() -> list:
-    (host, database, username, password, port) = load_env(
-        "../../postgresql_docker/.env_postgres"
+    return database.fetch_all(create_query())
+
+
+def create_daily_query() -> str:
+    """
+    Compute in the database, for each day, the number of distinct
+    customers and the total sales of the distinct purchases.
+    """
+    query = (
+        """
+        WITH purchases AS (
+            SELECT DISTINCT
+                event_time,
+                user_id,
+                price
+            FROM customers
+            WHERE event_type = 'purchase'
+        )
+        SELECT
+            date_trunc('day', event_time) AS day,
+            COUNT(DISTINCT user_id) AS customers,
+            SUM(price)::double precision AS sales
+        FROM purchases
+        GROUP BY day
+        ORDER BY day ASC;
+        """
     )
+    print(query)
+    return query
+
 
-    connection = psycopg2.connect(
-        host=host,
-        database=database,
-        user=username,
-        password=password,
-        port=port
+def create_monthly_query() -> str:
+    """
+    Compute in the database the total sales of the distinct purchases for
+    each mounth.
+    """
+    query = (
+        """
+        WITH purchases AS (
+            SELECT DISTINCT
+                event_time,
+                user_id,
+                price
+            FROM customers
+            WHERE event_type = 'purchase'
+        )
+        SELECT
+            date_trunc('month', event_time) AS mounth,
+            SUM(price)::double precision AS sales
+        FROM purchases
+        GROUP BY mounth
+        ORDER BY mounth ASC;
+        """
     )
+    print(query)
+    return query
 
-    query = create_query()
-    cursor = connection.cursor()
-    cursor.execute(query)
-    data = cursor.fetchall()
-    cursor.close()
-    connection.close()
 
-    return data
+def fetch_aggregates() -> tuple[dict, dict, dict]:
+    """
+    Return the data of the 3 charts, as aggregate_purchases does, but
+    aggregated by the database: only one row per day and per mounth is
+    transferred instead of every purchase.
+    """
+    number_of_customers_per_day = {}
+    average_spend_per_customer_per_day = {}
+    for day, customers, sales in database.fetch_all(create_daily_query()):
+        event_day = day.strftime("%Y-%m-%d")
+        number_of_customers_per_day[event_day] = customers
+        average_spend_per_customer_per_day[event_day] = sales / customers
+
+    sales_per_mounth = {
+        mounth.strftime("%Y-%m"): sales / 1_000_000
+        for mounth, sales in database.fetch_all(create_monthly_query())
+    }
+
+    return (
+        number_of_customers_per_day,
+        sales_per_mounth,
+        average_spend_per_customer_per_day
+    )
 
 
-def plot_customers_per_day(data: list):
+def fetch_batches(itersize: int):
+    """
+    Stream the purchases from a server-side cursor, in batches of at most
+    'itersize' rows.
+    """
+    return database.fetch_batches(create_query(), itersize=itersize)
 
-    plt.title("Number of distinct customers per day")
 
-    current_day = None
+def aggregate_purchases(batches: Iterable[list]) -> tuple[dict, dict, dict]:
+    """
+    Compute the data of the 3 charts from the purchases, given as a list
+    of batches of rows:
+    - The number of distinct customers per day.
+    - The total sales per mounth, in millions of A$.
+    - The average spend per customer per day.
+    Each batch is bucketed by day with an integer division of its epoch
+    timestamps, then reduced to its distinct (day, user_id) pairs and its
+    sales per day with hash-based pandas operations, so the work is linear
+    in the number of purchases and only the reduced batches are kept.
+    The days are counted in the timezone of the timestamps returned by
+    the database, each timestamp being shifted by its own UTC offset, as
+    a strftime of each timestamp would, daylight saving time included.
+    """
     daily_customers = []
-    number_of_customers_per_day = {}
+    daily_sales = []
+
+    for batch in batches:
+
+        if len(batch) == 0:
+            continue
+
+        purchases = pandas.DataFrame(
+            batch,
+            columns=["event_time", "user_id", "price"]
+        )
+
+        # The offset of each row, and not of the first one, so the days
+        # after a daylight saving time change are counted right.
+        utc_offsets = numpy.fromiter(
+            (
+                event_time.utcoffset().total_seconds()
+                for event_time, _, _ in batch
+            ),
+            dtype=numpy.int64,
+            count=len(batch)
+        )
+        seconds = pandas.to_datetime(
+            purchases["event_time"], utc=True
+        ).dt.tz_localize(None).to_numpy().astype("datetime64[s]").astype(
+            numpy.int64
+        )
+        days = (seconds + utc_offsets) // SECONDS_PER_DAY
 
-    for purchase in data:
+        daily_customers.append(
+            pandas.DataFrame(
+                {"day": days, "user_id": purchases["user_id"].to_numpy()}
+            ).drop_duplicates()
+        )
+        daily_sales.append(
+            purchases["price"].astype(float).groupby(days).sum()
+        )
 
-        event_day = purchase[0].strftime("%Y-%m-%d")
-        user_id = purchase[1]
+    if len(daily_sales) == 0:
+        return {}, {}, {}
 
-        if event_day != current_day:
-            current_day = event_day
-            daily_customers.clear()
+    customers = pandas.concat(daily_customers).drop_duplicates()[
+        "day"
+    ].value_counts().sort_index()
+    sales = pandas.concat(daily_sales).groupby(level=0).sum().sort_index()
 
-        if event_day not in number_of_customers_per_day:
-            number_of_customers_per_day[event_day] = 1
-        elif user_id not in daily_customers:
-            number_of_customers_per_day[event_day] += 1
-        else:
-            continue
+    days = pandas.to_datetime(
+        customers.index.to_numpy() * SECONDS_PER_DAY, unit="s"
+    ).strftime("%Y-%m-%d")
+    mounths = days.str[:7]
+
+    number_of_customers_per_day = dict(zip(days, customers.tolist()))
+    sales_per_mounth = (
+        (sales / 1_000_000).groupby(mounths.to_numpy()).sum().to_dict()
+    )
+    average_spend_per_customer_per_day = dict(
+        zip(days, (sales / customers).tolist())
+    )
+
+    return (
+        number_of_customers_per_day,
+        sales_per_mounth,
+        average_spend_per_customer_per_day
+    )
 
-        daily_customers.append(user_id)
+
+def plot_customers_per_day(number_of_customers_per_day: dict):
+
+    plt.title("Number of distinct customers per day")
 
     x = number_of_customers_per_day.keys()
     y = number_of_customers_per_day.values()
@@ -130,19 +245,10 @@ def plot_customers_per_day(data: list):
     plt.show()
 
 
-def plot_sales_per_mounth(data: list):
+def plot_sales_per_mounth(sales_per_mounth: dict):
 
     plt.title("Total sales per mounth in millions of Altarian Dollars (A$)")
 
-    sales_per_mounth = {}
-    for purchase in data:
-        event_mounth = purchase[0].strftime("%Y-%m")
-        sales = purchase[2] / 1_000_000
-        if event_mounth not in sales_per_mounth:
-            sales_per_mounth[event_mounth] = sales
-        else:
-            sales_per_mounth[event_mounth] += sales
-
     x = ["Oct", "Nov", "Dec", "Jan", "Feb"] if len(sales_per_mounth) == 5 \
         else sales_per_mounth.keys()
     y = sales_per_mounth.values()
@@ -155,32 +261,12 @@ def plot_sales_per_mounth(data: list):
     plt.show()
 
 
-def plot_average_spend_per_customer_per_day(data: list):
+def plot_average_spend_per_customer_per_day(
+    average_spend_per_customer_per_day: dict
+):
 
     plt.title("Average spend per customer per day")
 
-    current_day = None
-    customers_per_day = []
-    sales_per_day = {}
-    average_spend_per_customer_per_day = {}
-    for purchase in data:
-        event_day = purchase[0].strftime("%Y-%m-%d")
-        customers_id = purchase[1]
-        sales = purchase[2]
-
-        if event_day != current_day:
-            current_day = event_day
-            customers_per_day.clear()
-            sales_per_day[event_day] = 0
-            average_spend_per_customer_per_day[event_day] = 0
-
-        if customers_id not in customers_per_day:
-            customers_per_day.append(customers_id)
-
-        sales_per_day[event_day] += sales
-        average_spend_per_customer_per_day[event_day] = \
-            sales_per_day[event_day] / len(customers_per_day)
-
     x = average_spend_per_customer_per_day.keys()
     y = average_spend_per_customer_per_day.values()
 
@@ -190,7 +276,6 @@ def plot_average_spend_per_customer_per_day(data: list):
         color="blue",
         alpha=0.2
     )
-
     plt.ylabel("Average spend per customer per day in Altarian Dollars (A$)")
     plt.ylim(0)
     plt.xlabel("Date")
@@ -203,24 +288,73 @@ def plot_average_spend_per_customer_per_day(data: list):
     plt.show()
 
 
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Plot the customers and sales charts."
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--pushdown",
+        action="store_true",
+        help="aggregate the purchases per day and per mounth in the "
+             "database instead of fetching them"
+    )
+    mode.add_argument(
+        "--stream",
+        action="store_true",
+        help="stream the purchases from a server-side cursor instead of "
+             "fetching them all at once"
+    )
+    parser.add_argument(
+        "--itersize",
+        type=int,
+        default=database.STREAM_ITERSIZE,
+        help="number of rows per batch with --stream (default: %(default)s)"
+    )
+    arguments = parser.parse_args()
+    if arguments.itersize < 1:
+        parser.error("--itersize must be at least 1")
+    return arguments
+
+
 def main():
 
-    data = fetch_data()
+    arguments = parse_arguments()
 
-    # Data is a list of tuples.
-    # Each tuple contains 3 elements:
-    # - event_time
-    # - user_id
-    # - price
+    if arguments.pushdown:
+        aggregates = fetch_aggregates()
+    else:
+        if arguments.stream:
+            batches = fetch_batches(arguments.itersize)
+        else:
+            batches = [fetch_data()]
+
+        # Purchases are tuples of 3 elements:
+        # - event_time
+        # - user_id
+        # - price
+
+        aggregates = aggregate_purchases(batches)
+
+    (
+        number_of_customers_per_day,
+        sales_per_mounth,
+        average_spend_per_customer_per_day
+    ) = aggregates
 
     # Plot a chart with the number of customers per day.
-    plot_customers_per_day(data)
+    plot_customers_per_day(number_of_customers_per_day)
 
     # Plot a chart with the total sales per mounth.
-    plot_sales_per_mounth(data)
+    plot_sales_per_mounth(sales_per_mounth)
 
     # Plot a chart with the average spend per customer per day.
-    plot_average_spend_per_customer_per_day(data)
+    plot_average_spend_per_customer_per_day(
+        average_spend_per_customer_per_day
+    )
 
 
 if __name__ == "__main__":
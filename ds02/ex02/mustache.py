@@ -11,35 +11,15 @@
 # *************************************************************************** #
 
 import os
-from dotenv import load_dotenv
-import psycopg2
+import sys
+import argparse
 import pandas
 import matplotlib.pyplot as plt
 
-
-def load_env(dotenv_path: str) -> tuple:
-    """
-    Load the postgresql config from the .env_postgres file.
-    Return a tuple with the config.
-    """
-    env_file_loaded = load_dotenv(dotenv_path)
-    if env_file_loaded is False:
-        raise FileNotFoundError(
-            "The .env_postgres file is missing or is empty."
-        )
-    environment_variables = (
-        os.getenv('POSTGRES_HOST'),
-        os.getenv('POSTGRES_DB'),
-        os.getenv('POSTGRES_USER'),
-        os.getenv('POSTGRES_PASSWORD'),
-        os.getenv('POSTGRES_PORT')
-    )
-    if any(variable is None for variable in environment_variables):
-        raise ValueError(
-            "One or more config variables are missing.\n" +
-            "Please check the .env_postgres file."
-        )
-    return environment_variables
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+)
+from common import database  # noqa: E402
 
 
 def create_query_1() -> str:
@@ -48,7 +28,7 @@ def create_query_1() -> str:
         """
         SELECT DISTINCT
             event_time,
-            price,
+            price::double precision AS price,
             user_id
         FROM customers
             WHERE event_type = 'purchase' AND event_time < '2023-02-01';
@@ -71,7 +51,7 @@ def create_query_2() -> str:
         ),
         average_basket_prices AS (
             SELECT user_id,
-                   AVG(basket_price) AS avg_basket_price
+                   AVG(basket_price)::double precision AS avg_basket_price
             FROM baskets
             GROUP BY user_id
         )
@@ -84,33 +64,166 @@ def create_query_2() -> str:
     return query
 
 
-def fetch_data(index: int) -> list:
-    (host, database, username, password, port) = load_env(
-        "../../postgresql_docker/.env_postgres"
-    )
+def create_summary_query_2() -> str:
 
-    connection = psycopg2.connect(
-        host=host,
-        database=database,
-        user=username,
-        password=password,
-        port=port
+    query = (
+        """
+        SELECT user_id,
+               avg_basket_price
+        FROM summary_users;
+        """
     )
+    print("\nQuery used to fetch the data for the last plot:\n", query)
+    return query
+
+
+# Column of each query whose distribution is drawn by the plots.
+VALUE_COLUMNS = {1: "price", 2: "avg_basket_price"}
 
+
+def create_data_query(index: int, summaries: bool = False) -> str:
+    """
+    Create the query 'index' fetching the data of the plots.
+    """
     query = {
         1: create_query_1,
-        2: create_query_2
+        2: create_summary_query_2 if summaries else create_query_2
     }
+    return query[index]()
+
+
+def fetch_data(index: int, summaries: bool = False) -> list:
 
-    cursor = connection.cursor()
-    cursor.execute(query[index]())
-    data = cursor.fetchall()
-    cursor.close()
-    connection.close()
+    data = database.fetch_all(create_data_query(index, summaries))
 
     return data
 
 
+def create_source_query(index: int, summaries: bool = False) -> str:
+    """
+    Values, named 'value', whose distribution is drawn by the plots using
+    the data of the query 'index', selected from this query used as a
+    subquery.
+    """
+    data_query = create_data_query(index, summaries).strip().rstrip(";")
+    return (
+        f"""
+            SELECT {VALUE_COLUMNS[index]} AS value
+            FROM (
+                {data_query}
+            ) AS plotted_data
+        """
+    )
+
+
+def create_stats_query(source: str) -> str:
+    """
+    Compute in the database the statistics of the 'value' column of the
+    'source' query needed to describe it and to draw its box plot:
+    quartiles with linear interpolation (as numpy and matplotlib do),
+    whiskers at the furthest values within 1.5 IQR of the box, and the
+    distinct values beyond them, the outliers.
+    """
+
+    query = (
+        f"""
+        WITH data AS (
+            {source.strip()}
+        ),
+        quartiles AS (
+            SELECT
+                COUNT(value) AS count,
+                AVG(value) AS mean,
+                STDDEV_SAMP(value) AS std,
+                MIN(value) AS min,
+                percentile_cont(ARRAY[0.25, 0.5, 0.75])
+                    WITHIN GROUP (ORDER BY value) AS q,
+                MAX(value) AS max
+            FROM data
+        ),
+        fences AS (
+            SELECT
+                *,
+                q[1] - 1.5 * (q[3] - q[1]) AS low_fence,
+                q[3] + 1.5 * (q[3] - q[1]) AS high_fence
+            FROM quartiles
+        )
+        SELECT
+            fences.count,
+            fences.mean,
+            fences.std,
+            fences.min,
+            fences.q[1],
+            fences.q[2],
+            fences.q[3],
+            fences.max,
+            MIN(data.value) FILTER (WHERE data.value >= fences.low_fence),
+            MAX(data.value) FILTER (WHERE data.value <= fences.high_fence),
+            array_agg(DISTINCT data.value ORDER BY data.value) FILTER (
+                WHERE data.value < fences.low_fence
+                OR data.value > fences.high_fence
+            )
+        FROM fences
+        CROSS JOIN data
+        GROUP BY
+            fences.count, fences.mean, fences.std, fences.min,
+            fences.q, fences.max;
+        """
+    )
+    print(query)
+    return query
+
+
+def fetch_box_stats(index: int, summaries: bool = False) -> dict:
+    """
+    Fetch the statistics of the values of the query 'index', in the format
+    expected by Axes.bxp, plus the count, mean and std used to describe
+    them. Only the distinct outliers are transferred, not the values.
+    """
+    query = create_stats_query(create_source_query(index, summaries))
+    data = database.fetch_all(query)
+    if len(data) == 0:
+        raise ValueError("No data to compute the statistics from.")
+    (
+        count, mean, std, minimum, q1, med, q3, maximum,
+        whislo, whishi, fliers
+    ) = data[0]
+
+    stats = {
+        "count": count,
+        "mean": mean,
+        "std": std,
+        "min": minimum,
+        "q1": q1,
+        "med": med,
+        "q3": q3,
+        "max": maximum,
+        "whislo": whislo,
+        "whishi": whishi,
+        "fliers": fliers or [],
+    }
+    if q1 == q3:
+        # Same as matplotlib autorange: whiskers at the min and max.
+        stats["whislo"], stats["whishi"] = minimum, maximum
+        stats["fliers"] = []
+    return stats
+
+
+def describe_stats(stats: dict) -> pandas.Series:
+    """
+    Same output as pandas.Series.describe from the precomputed statistics.
+    """
+    return pandas.Series(
+        [
+            stats["count"], stats["mean"], stats["std"], stats["min"],
+            stats["q1"], stats["med"], stats["q3"], stats["max"]
+        ],
+        index=["count", "mean", "std", "min", "25%", "50%", "75%", "max"],
+        name="price",
+        dtype=float,
+    )
+
+
 def box_plot_with_outliers(dataframe: pandas.DataFrame) -> None:
     """
     Create a box plot with outliers.
@@ -169,8 +282,85 @@ def box_plot_avg(dataframe: pandas.DataFrame) -> None:
     plt.show()
 
 
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Plot the box plots of the purchase prices."
+    )
+    parser.add_argument(
+        "--summaries",
+        action="store_true",
+        help="read the average basket prices from the summary tables "
+             "instead of the customers table"
+    )
+    parser.add_argument(
+        "--pushdown",
+        action="store_true",
+        help="compute the quartiles, whiskers and outliers in the database "
+             "instead of fetching all the prices"
+    )
+    return parser.parse_args()
+
+
+def box_plot_from_stats(
+    stats: dict,
+    title: str,
+    label: str,
+    showfliers: bool
+) -> None:
+    """
+    Create a box plot from the precomputed statistics.
+    """
+    plt.title(title)
+    plt.gca().bxp(
+        bxpstats=[dict(stats, label=label)],
+        vert=False,                 # Vertical or horizontal.
+        patch_artist=True,          # Fill with color.
+        showfliers=showfliers,      # Show the outliers.
+        flierprops=dict(
+            markerfacecolor='black',
+            marker='D',
+            markersize=2,
+        ),
+    )
+    plt.grid(True, axis='x')
+    plt.xlabel("Price in A$")
+    plt.show()
+
+
+def plot_from_stats(summaries: bool) -> None:
+    """
+    Draw the same plots as main from statistics computed in the database.
+    """
+    stats = fetch_box_stats(1)
+    print(describe_stats(stats))
+
+    box_plot_from_stats(stats, "Price distribution", "Purchase", True)
+
+    box_plot_from_stats(
+        stats, "Price distribution without outliers", "Purchase", False
+    )
+
+    stats = fetch_box_stats(2, summaries)
+
+    box_plot_from_stats(
+        stats,
+        "Average basket price per user",
+        "Average basket price",
+        True
+    )
+
+
 def main():
 
+    arguments = parse_arguments()
+
+    if arguments.pushdown:
+        plot_from_stats(arguments.summaries)
+        return
+
     data = fetch_data(1)
 
     complete_df = pandas.DataFrame(
@@ -187,7 +377,7 @@ def main():
 
     # wtf w/ the subject last plot ?
 
-    data = fetch_data(2)
+    data = fetch_data(2, arguments.summaries)
 
     dataframe = pandas.DataFrame(
         data,
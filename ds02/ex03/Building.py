@@ -11,35 +11,15 @@
 # *************************************************************************** #
 
 import os
-from dotenv import load_dotenv
-import psycopg2
+import sys
+import argparse
 import matplotlib.pyplot as plt
 import pandas
 
-
-def load_env(dotenv_path: str) -> tuple:
-    """
-    Load the postgresql config from the .env_postgres file.
-    Return a tuple with the config.
-    """
-    env_file_loaded = load_dotenv(dotenv_path)
-    if env_file_loaded is False:
-        raise FileNotFoundError(
-            "The .env_postgres file is missing or is empty."
-        )
-    environment_variables = (
-        os.getenv('POSTGRES_HOST'),
-        os.getenv('POSTGRES_DB'),
-        os.getenv('POSTGRES_USER'),
-        os.getenv('POSTGRES_PASSWORD'),
-        os.getenv('POSTGRES_PORT')
-    )
-    if any(variable is None for variable in environment_variables):
-        raise ValueError(
-            "One or more config variables are missing.\n" +
-            "Please check the .env_postgres file."
-        )
-    return environment_variables
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+)
+from common import database  # noqa: E402
 
 
 def create_query_1() -> str:
@@ -75,7 +55,7 @@ def create_query_2() -> str:
         """
             SELECT
                 user_id,
-                SUM(price) AS spent
+                SUM(price)::double precision AS spent
             FROM
                 customers
             WHERE
@@ -92,37 +72,88 @@ def create_query_2() -> str:
     return query
 
 
-def fetch_data(querry_number: int) -> list:
-    (host, database, username, password, port) = load_env(
-        "../../postgresql_docker/.env_postgres"
+def create_summary_query_1() -> str:
+    """
+    Same as create_query_1, from the summary_users table.
+    """
+
+    query = (
+        """
+            SELECT
+                user_id,
+                purchases AS frequency
+            FROM
+                summary_users
+            WHERE
+                purchases < 40
+            ORDER BY
+                purchases ASC;
+        """
     )
+    print(query)
+    return query
+
 
-    connection = psycopg2.connect(
-        host=host,
-        database=database,
-        user=username,
-        password=password,
-        port=port
+def create_summary_query_2() -> str:
+    """
+    Same as create_query_2, from the summary_users table.
+    """
+
+    query = (
+        """
+            SELECT
+                user_id,
+                spent
+            FROM
+                summary_users
+            WHERE
+                spent < 225
+            ORDER BY
+                spent ASC;
+        """
     )
+    print(query)
+    return query
+
 
-    querries = {
-        1: create_query_1,
-        2: create_query_2
-    }
+def fetch_data(querry_number: int, summaries: bool = False) -> list:
+    if summaries:
+        querries = {
+            1: create_summary_query_1,
+            2: create_summary_query_2
+        }
+    else:
+        querries = {
+            1: create_query_1,
+            2: create_query_2
+        }
 
     query = querries[querry_number]()
-    cursor = connection.cursor()
-    cursor.execute(query)
-    data = cursor.fetchall()
-    cursor.close()
-    connection.close()
+    data = database.fetch_all(query)
 
     return data
 
 
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Plot the frequency and monetary distributions."
+    )
+    parser.add_argument(
+        "--summaries",
+        action="store_true",
+        help="read the summary tables instead of the customers table"
+    )
+    return parser.parse_args()
+
+
 def main():
 
-    data = fetch_data(1)
+    arguments = parse_arguments()
+
+    data = fetch_data(1, arguments.summaries)
     dataframe = pandas.DataFrame(data, columns=['id', 'frequency'])
 
     # Plot a bar chart with the number of orders per customer distribution
@@ -133,7 +164,7 @@ def main():
     plt.grid(alpha=0.75)
     plt.show()
 
-    data = fetch_data(2)
+    data = fetch_data(2, arguments.summaries)
     dataframe = pandas.DataFrame(data, columns=['id', 'frequency'])
 
     # Plot a bar chart with the $ spent per user distribution
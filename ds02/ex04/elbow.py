@@ -14,107 +14,166 @@
 # the k-means algorithm.
 
 import os
-from dotenv import load_dotenv
-import psycopg2
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import matplotlib.pyplot as plt
-import pandas
 
-from sklearn.cluster import KMeans
+from threadpoolctl import threadpool_limits
 
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+)
+from common import rfm, clustering  # noqa: E402
 
-def load_env(dotenv_path: str) -> tuple:
-    """
-    Load the postgresql config from the .env_postgres file.
-    Return a tuple with the config.
-    """
-    env_file_loaded = load_dotenv(dotenv_path)
-    if env_file_loaded is False:
-        raise FileNotFoundError(
-            "The .env_postgres file is missing or is empty."
-        )
-    environment_variables = (
-        os.getenv('POSTGRES_HOST'),
-        os.getenv('POSTGRES_DB'),
-        os.getenv('POSTGRES_USER'),
-        os.getenv('POSTGRES_PASSWORD'),
-        os.getenv('POSTGRES_PORT')
-    )
-    if any(variable is None for variable in environment_variables):
-        raise ValueError(
-            "One or more config variables are missing.\n" +
-            "Please check the .env_postgres file."
-        )
-    return environment_variables
-
-
-def create_query() -> str:
-
-    query = (
-        """
-        SELECT
-            user_id,
-            event_time,
-            price
-        FROM customers
-        WHERE event_type = 'purchase'
-        GROUP BY
-            user_id,
-            event_time,
-            price
-        ORDER BY user_id;
-        """
-    )
-    print(query)
-    return query
+MAX_CLUSTERS = 10
 
+# Data, fit options and thread limits of the current worker process, set
+# once by init_worker instead of being sent with each k.
+_worker_data = None
+_worker_options = None
+_worker_limits = None
 
-def fetch_data() -> list:
-    (host, database, username, password, port) = load_env(
-        "../../postgresql_docker/.env_postgres"
-    )
 
-    connection = psycopg2.connect(
-        host=host,
-        database=database,
-        user=username,
-        password=password,
-        port=port
-    )
+def init_worker(data, options: dict, threads: int) -> None:
+    """
+    Keep the data and the fit options in the worker process and limit the
+    number of threads used by its BLAS and OpenMP libraries, so the
+    workers do not oversubscribe the CPUs.
+    """
+    global _worker_data, _worker_options, _worker_limits
+    _worker_data = data
+    _worker_options = options
+    _worker_limits = threadpool_limits(limits=threads)
 
-    query = create_query()
-    cursor = connection.cursor()
-    cursor.execute(query)
-    data = cursor.fetchall()
-    cursor.close()
-    connection.close()
 
-    return data
+def fit_inertia(
+    n_clusters: int,
+    data=None,
+    options: dict | None = None
+) -> tuple[int, float, float]:
+    """
+    Fit k-means with 'n_clusters' clusters on the data, or on the data of
+    the worker process, and return the number of clusters, the inertia
+    on all the data and the time taken by the fit.
+    The options select the fit method (see clustering.fit) and whether to
+    compare it with a full fit.
+    """
+    if data is None:
+        data, options = _worker_data, _worker_options
+    options = options or {}
+    model, elapsed = clustering.fit(
+        data,
+        n_clusters,
+        options.get("method", "full"),
+        max_iter=1000,
+        n_init=10,
+        sample_size=options.get("sample_size", clustering.SAMPLE_SIZE),
+        batch_size=options.get("batch_size", clustering.BATCH_SIZE),
+        random_state=options.get("seed"),
+    )
+    if options.get("compare"):
+        inertia, _ = clustering.compare_with_full(
+            model, elapsed, data, max_iter=1000, n_init=10,
+            random_state=options.get("seed")
+        )
+    elif options.get("method", "full") == "full":
+        inertia = model.inertia_
+    else:
+        inertia = clustering.inertia(model, data)
+    return n_clusters, inertia, elapsed
+
+
+def sweep_sequentially(
+    data,
+    max_clusters: int,
+    options: dict | None = None
+) -> dict:
+    """
+    Fit k-means for each number of clusters from 1 to 'max_clusters', one
+    after the other, and return the inertia of each.
+    """
+    inertia = {}
+    for n_clusters in range(1, max_clusters + 1):
+        print(f"Clustering step {n_clusters}/{max_clusters}")
+        _, inertia[n_clusters], elapsed = fit_inertia(
+            n_clusters, data, options
+        )
+        print(f"k={n_clusters} fitted in {elapsed:.3f}s")
+    return inertia
 
 
-def main():
+def sweep_in_parallel(
+    data,
+    max_clusters: int,
+    jobs: int,
+    options: dict | None = None
+) -> dict:
+    """
+    Same as sweep_sequentially with one k per task dispatched to 'jobs'
+    worker processes sharing the CPUs.
+    The largest k, which take the longest to fit, are submitted first and
+    the results are reported as soon as they are done.
+    """
+    threads = max(1, (os.cpu_count() or 1) // jobs)
+    inertia = {}
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=init_worker,
+        initargs=(data, options, threads)
+    ) as executor:
+        futures = [
+            executor.submit(fit_inertia, n_clusters)
+            for n_clusters in range(max_clusters, 0, -1)
+        ]
+        for done, future in enumerate(as_completed(futures), start=1):
+            n_clusters, inertia[n_clusters], elapsed = future.result()
+            print(
+                f"Clustering step {done}/{max_clusters}: "
+                f"k={n_clusters} fitted in {elapsed:.3f}s"
+            )
+    return inertia
 
-    data = fetch_data()
 
-    customers = pandas.DataFrame(
-        data,
-        columns=[
-            "user_id",
-            "event_time",
-            "price"
-        ]
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Plot the inertia of k-means depending on the number of "
+                    "clusters."
     )
-    # Convert event_time into an integer, the minimum value is 0, each day is 1
-    max_date = customers["event_time"].max()
-    customers["event_time"] = customers["event_time"].apply(
-        lambda x: (max_date - x).days + 1
+    rfm.add_arguments(parser)
+    clustering.add_arguments(parser)
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of worker processes fitting the k in parallel "
+             "(default: %(default)s)"
     )
+    arguments = parser.parse_args()
+    if arguments.itersize < 1:
+        parser.error("--itersize must be at least 1")
+    if arguments.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    clustering.check_arguments(parser, arguments)
+    return arguments
 
-    customers = customers.groupby("user_id")
 
-    customers = customers.agg(
-        recency=("event_time", "min"),
-        frequency=("event_time", "count"),
-        monetary=("price", "sum")
+def main():
+
+    arguments = parse_arguments()
+
+    # Recency, frequency and monetary value of each customer, the recency
+    # being an integer number of days, the minimum value is 1
+    customers = rfm.get_features(
+        recency_from="end",
+        stream=arguments.stream,
+        pushdown=arguments.pushdown,
+        itersize=arguments.itersize,
+        use_cache=arguments.use_cache
     )
 
     # customers = pandas.DataFrame(
@@ -130,38 +189,36 @@ def main():
 
     print(customers.head(), "\n")
 
+    # Scaling, so each feature weights the same in the distances
+    customers, _ = clustering.preprocess(
+        customers,
+        arguments.scaling,
+        log=["monetary"] if arguments.log_monetary else []
+    )
+
     # Inertia can be recognized as a measure of how internally coherent
     # clusters are.
-    inertia = []
-    max_clusters = 10
-    for n_clusters in range(1, max_clusters + 1):
-
-        print(f"Clustering step {n_clusters}/{max_clusters}")
-
-        kmean = KMeans(
-            n_clusters=n_clusters,
-            max_iter=1000,
-            n_init=10,
-        )
-        kmean.fit(customers)
-        inertia.append(kmean.inertia_)
-
-        # Plot the data with the clusters with a 3D graph
-        # ax = plt.figure().add_subplot(projection='3d')
-        # ax.scatter(
-        #     customers['nb_orders'],
-        #     customers['total_spent'],
-        #     customers['avg_spent'],
-        #     c=kmean.labels_
-        # )
-        # plt.show()
+    options = {
+        "method": arguments.method,
+        "sample_size": arguments.sample_size,
+        "batch_size": arguments.batch_size,
+        "compare": arguments.compare,
+        "seed": arguments.seed,
+    }
+    start = time.perf_counter()
+    if arguments.jobs > 1:
+        jobs = min(arguments.jobs, MAX_CLUSTERS)
+        inertia = sweep_in_parallel(customers, MAX_CLUSTERS, jobs, options)
+    else:
+        inertia = sweep_sequentially(customers, MAX_CLUSTERS, options)
+    print(f"Elbow sweep done in {time.perf_counter() - start:.3f}s")
 
     # Plot the inertia depending on the number of clusters
     # to find the optimal number of clusters
     plt.title("Inertia depending on the number of clusters")
     plt.plot(
-        range(1, max_clusters + 1),
-        inertia
+        sorted(inertia),
+        [inertia[n_clusters] for n_clusters in sorted(inertia)]
     )
     plt.xlabel("Number of clusters")
     plt.ylabel("Inertia")
@@ -10,148 +10,181 @@
 #                                                                             #
 # *************************************************************************** #
 
+# Your boss wants to make groups of type of customer to make a commercial
+# targeting with offers by e-mails
+# (welcome offers for new customers, coupon to bring back old customers,
+# special status for loyal customers like: gold, silver, platinum ...)
+#
+# Make at least 4 groups (new customer, inactive customer, loyalty status:
+# gold + silver + platinum ...)
+#
+# Clustering will be based on:
+# - Median frequency of purchase : number of days between two purchases
+# - Median recency of purchase : number of days since the last purchase
+
 import os
-from dotenv import load_dotenv
-import psycopg2
-import pandas
+import sys
+import argparse
+import numpy
 import matplotlib.pyplot as plt
 
-from sklearn.cluster import KMeans
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+)
+from common import rfm, clustering  # noqa: E402
+
+FEATURES = ["recency", "frequency", "monetary"]
 
+STATUS = [
+    "New customer",         #
+    "Potential Loyalists",  #
+    "Champions",            #
+    "Can’t Lose Them",      #
+    "At Risk Customers"     #
+]
 
-def load_env(dotenv_path: str) -> tuple:
+
+def map_status(centroids: numpy.ndarray) -> numpy.ndarray:
     """
-    Load the postgresql config from the .env_postgres file.
-    Return a tuple with the config.
+    Return the index in STATUS of each cluster, from the ordering of its
+    centroid (recency, frequency, monetary) among the other centroids, so
+    the same groups of customers get the same status from a run to
+    another, whatever the order in which k-means found them.
+    The recency is counted from the start of the data, a customer with a
+    bigger recency bought more recently.
+    - Champions: recent buyers, buying often and spending a lot,
+    - New customer: recent buyers, buying little,
+    - At Risk Customers: old buyers, buying little,
+    - Can’t Lose Them: the old buyers, buying often or spending a lot,
+    - Potential Loyalists: the last group.
     """
-    env_file_loaded = load_dotenv(dotenv_path)
-    if env_file_loaded is False:
-        raise FileNotFoundError(
-            "The .env_postgres file is missing or is empty."
-        )
-    environment_variables = (
-        os.getenv('POSTGRES_HOST'),
-        os.getenv('POSTGRES_DB'),
-        os.getenv('POSTGRES_USER'),
-        os.getenv('POSTGRES_PASSWORD'),
-        os.getenv('POSTGRES_PORT')
-    )
-    if any(variable is None for variable in environment_variables):
+    if len(centroids) != len(STATUS):
         raise ValueError(
-            "One or more config variables are missing.\n" +
-            "Please check the .env_postgres file."
+            f"Expected {len(STATUS)} clusters, got {len(centroids)}."
         )
-    return environment_variables
+    ranks = numpy.asarray(centroids).argsort(axis=0).argsort(axis=0)
+    recent = ranks[:, 0]
+    value = ranks[:, 1] + ranks[:, 2]
+
+    rules = [
+        ("Champions", lambda c: (recent[c] + value[c], value[c])),
+        ("New customer", lambda c: (recent[c] - value[c], recent[c])),
+        ("At Risk Customers", lambda c: (-recent[c] - value[c], -value[c])),
+        ("Can’t Lose Them", lambda c: (value[c], -recent[c])),
+        ("Potential Loyalists", lambda c: 0),
+    ]
+    remaining = list(range(len(centroids)))
+    status_index = numpy.empty(len(centroids), dtype=int)
+    for status, key in rules:
+        cluster = max(remaining, key=key)
+        remaining.remove(cluster)
+        status_index[cluster] = STATUS.index(status)
+    return status_index
 
 
-def create_query() -> str:
+def parse_arguments() -> argparse.Namespace:
     """
-    Your boss wants to make groups of type of customer to make a commercial
-    targeting with offers by e-mails
-    (welcome offers for new customers, coupon to bring back old customers,
-    special status for loyal customers like: gold, silver, platinum ...)
-
-    Make at least 4 groups (new customer, inactive customer, loyalty status:
-    gold + silver + platinum ...)
-
-    Clustering will be based on:
-    - Median frequency of purchase : number of days between two purchases
-    - Median recency of purchase : number of days since the last purchase
+    Parse the command line arguments.
     """
-
-    query = (
-        """
-        SELECT
-            user_id,
-            event_time,
-            price
-        FROM customers
-        WHERE event_type = 'purchase'
-        GROUP BY
-            user_id,
-            event_time,
-            price
-        ORDER BY user_id;
-        """
+    parser = argparse.ArgumentParser(
+        description="Make groups of customers with k-means."
     )
-    print(query)
-    return query
-
-
-def fetch_data() -> list:
-    (host, database, username, password, port) = load_env(
-        "../../postgresql_docker/.env_postgres"
+    rfm.add_arguments(parser)
+    clustering.add_arguments(parser)
+    parser.add_argument(
+        "--save-model",
+        nargs="?",
+        const=clustering.MODEL_PATH,
+        metavar="PATH",
+        help="save the fitted model, to assign new customers with "
+             f"score.py (default path: {clustering.MODEL_PATH})"
     )
-
-    connection = psycopg2.connect(
-        host=host,
-        database=database,
-        user=username,
-        password=password,
-        port=port
-    )
-
-    query = create_query()
-    cursor = connection.cursor()
-    cursor.execute(query)
-    data = cursor.fetchall()
-    cursor.close()
-    connection.close()
-
-    return data
+    arguments = parser.parse_args()
+    if arguments.itersize < 1:
+        parser.error("--itersize must be at least 1")
+    clustering.check_arguments(parser, arguments)
+    return arguments
 
 
 def main():
 
-    data = fetch_data()
+    arguments = parse_arguments()
 
-    customers = pandas.DataFrame(
-        data,
-        columns=[
-            "user_id",
-            "event_time",
-            "price"
-        ]
+    # Recency, frequency and monetary value of each customer, the recency
+    # being an integer number of days, the minimum value is 1
+    aggregates = rfm.get_aggregates(
+        stream=arguments.stream,
+        pushdown=arguments.pushdown,
+        itersize=arguments.itersize,
+        use_cache=arguments.use_cache
     )
+    reference_date = rfm.get_reference_date(aggregates, "start")
+    customers = rfm.compute_features(aggregates, "start", reference_date)
 
-    print(customers, "\n")
-
-    # Create a new dataframe grouped by user_id and with :
-
-    # Convert event_time into an integer, the minimum value is 0, each day is 1
-    min_date = customers["event_time"].min()
-    customers["event_time"] = customers["event_time"].apply(
-        lambda x: (x - min_date).days + 1
-    )
-
-    customers = customers.groupby("user_id")
+    print(customers)
 
-    customers = customers.agg(
-        recency=("event_time", "max"),
-        frequency=("event_time", "count"),
-        monetary=("price", "sum")
+    # Scaling, so each feature weights the same in the distances
+    features, scaler = clustering.preprocess(
+        customers,
+        arguments.scaling,
+        log=["monetary"] if arguments.log_monetary else []
     )
 
-    print(customers)
-
     # Clustering
     # K-means algorithm
-    KMeans_model = KMeans(n_clusters=5, n_init=10, max_iter=50_000)
-    KMeans_model.fit(customers)
-    customers["cluster"] = KMeans_model.predict(customers)
-
-    status = [
-        "New customer",         #
-        "Potential Loyalists",  #
-        "Champions",            #
-        "Can’t Lose Them",      #
-        "At Risk Customers"     #
-    ]
+    KMeans_model, elapsed = clustering.fit(
+        features,
+        n_clusters=len(STATUS),
+        method=arguments.method,
+        max_iter=50_000,
+        n_init=10,
+        sample_size=arguments.sample_size,
+        batch_size=arguments.batch_size,
+        random_state=arguments.seed
+    )
+    print(
+        f"k-means fitted in {elapsed:.3f}s, "
+        f"{KMeans_model.n_iter_} iterations"
+    )
+    if arguments.compare:
+        clustering.compare_with_full(
+            KMeans_model, elapsed, features, max_iter=50_000, n_init=10,
+            random_state=arguments.seed
+        )
+    if arguments.method == "full":
+        # The customers were all used to fit, no need to assign them again.
+        labels = KMeans_model.labels_
+    else:
+        labels = clustering.predict(KMeans_model, features)
+
+    # Number the clusters by status, cluster i having the status STATUS[i],
+    # and get their centroids in the units of the features.
+    status_index = map_status(
+        clustering.unscale(scaler, KMeans_model.cluster_centers_)
+    )
+    scaled_centroids = numpy.empty_like(KMeans_model.cluster_centers_)
+    scaled_centroids[status_index] = KMeans_model.cluster_centers_
+    centroids = clustering.unscale(scaler, scaled_centroids)
+    customers["cluster"] = status_index[labels]
+
+    status = STATUS
 
     customers["status"] = customers["cluster"].apply(
         lambda x: status[x]
     )
 
+    if arguments.save_model is not None:
+        clustering.save_model(
+            arguments.save_model,
+            scaled_centroids,
+            status,
+            features=FEATURES,
+            recency_from="start",
+            reference_date=reference_date,
+            watermark=aggregates["last_purchase"].max(),
+            scaler=scaler
+        )
+
     fig, ax = plt.subplots(1, 3, figsize=(20, 6))
 
     fig.suptitle("Customers clustering")
@@ -164,8 +197,8 @@ def main():
     )
     # Plot the centroids
     ax[0].scatter(
-        KMeans_model.cluster_centers_[:, 0],
-        KMeans_model.cluster_centers_[:, 1],
+        centroids[:, 0],
+        centroids[:, 1],
         c='red',
         s=50,
         alpha=0.5
@@ -182,8 +215,8 @@ def main():
     )
     # Plot the centroids
     ax[1].scatter(
-        KMeans_model.cluster_centers_[:, 1],
-        KMeans_model.cluster_centers_[:, 2],
+        centroids[:, 1],
+        centroids[:, 2],
         c='red',
         s=50,
         alpha=0.5
@@ -199,8 +232,8 @@ def main():
     )
     # Plot the centroids
     ax[2].scatter(
-        KMeans_model.cluster_centers_[:, 0],
-        KMeans_model.cluster_centers_[:, 2],
+        centroids[:, 0],
+        centroids[:, 2],
         c='red',
         s=50,
         alpha=0.5
@@ -224,18 +257,18 @@ def main():
     for i, txt in enumerate(status):
         ax[0].annotate(
             txt,
-            (KMeans_model.cluster_centers_[i, 0],
-             KMeans_model.cluster_centers_[i, 1])
+            (centroids[i, 0],
+             centroids[i, 1])
         )
         ax[1].annotate(
             txt,
-            (KMeans_model.cluster_centers_[i, 1],
-             KMeans_model.cluster_centers_[i, 2])
+            (centroids[i, 1],
+             centroids[i, 2])
         )
         ax[2].annotate(
             txt,
-            (KMeans_model.cluster_centers_[i, 2],
-             KMeans_model.cluster_centers_[i, 0])
+            (centroids[i, 2],
+             centroids[i, 0])
         )
 
     plt.show()
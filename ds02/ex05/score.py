@@ -0,0 +1,214 @@
+# *************************************************************************** #
+#                                                                             #
+#                                                        :::      ::::::::    #
+#    score.py                                          :+:      :+:    :+:    #
+#                                                    +:+ +:+         +:+      #
+#    By: cmariot <cmariot@student.42.fr>           +#+  +:+       +#+         #
+#                                                +#+#+#+#+#+   +#+            #
+#    Created: 2026/10/18 16:04:27 by cmariot          #+#    #+#              #
+#    Updated: 2026/10/18 16:04:27 by cmariot         ###   ########.fr        #
+#                                                                             #
+# *************************************************************************** #
+
+# Assign the new and changed customers to the clusters of the model saved by
+# Clustering.py --save-model, without fitting it again, and store their
+# segment in the customer_segments table.
+
+import os
+import sys
+import time
+import argparse
+import pandas
+from psycopg2.extras import execute_values
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+)
+from common import database, rfm, clustering  # noqa: E402
+
+
+def create_table_query() -> str:
+
+    query = (
+        """
+        CREATE TABLE IF NOT EXISTS customer_segments
+        (
+            user_id         BIGINT PRIMARY KEY,
+            cluster         SMALLINT NOT NULL,
+            status          TEXT NOT NULL,
+            recency         INTEGER NOT NULL,
+            frequency       INTEGER NOT NULL,
+            monetary        DOUBLE PRECISION NOT NULL,
+            last_purchase   TIMESTAMP WITH TIME ZONE NOT NULL,
+            model_version   TEXT NOT NULL,
+            scored_at       TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+        );
+        """
+    )
+    print(query)
+    return query
+
+
+def create_upsert_query() -> str:
+
+    query = (
+        """
+        INSERT INTO customer_segments (
+            user_id, cluster, status, recency, frequency, monetary,
+            last_purchase, model_version
+        )
+        VALUES %s
+        ON CONFLICT (user_id) DO UPDATE SET
+            cluster = EXCLUDED.cluster,
+            status = EXCLUDED.status,
+            recency = EXCLUDED.recency,
+            frequency = EXCLUDED.frequency,
+            monetary = EXCLUDED.monetary,
+            last_purchase = EXCLUDED.last_purchase,
+            model_version = EXCLUDED.model_version,
+            scored_at = now();
+        """
+    )
+    return query
+
+
+def get_since(version: str, rescore_all: bool):
+    """
+    Return the date from which the customers with a purchase are scored:
+    the last purchase already scored with this version of the model, or
+    -infinity to score all the customers when the model was never used.
+    """
+    if rescore_all:
+        return "-infinity"
+    data = database.fetch_all(
+        """
+        SELECT MAX(last_purchase)
+        FROM customer_segments
+        WHERE model_version = %s;
+        """,
+        (version,)
+    )
+    since = data[0][0]
+    return "-infinity" if since is None else since
+
+
+def score_batch(saved: dict, batch: list) -> list[tuple]:
+    """
+    Compute the features of a batch of aggregates and assign them to the
+    clusters of the model.
+    Return the rows to store in the customer_segments table.
+    """
+    aggregates = pandas.DataFrame(
+        batch,
+        columns=["user_id", *rfm.AGGREGATES_COLUMNS]
+    ).set_index("user_id")
+    features = rfm.compute_features(
+        aggregates,
+        saved["recency_from"],
+        saved["reference_date"]
+    )
+    clusters = clustering.score(saved, features)
+    status = [saved["status"][cluster] for cluster in clusters]
+    return list(zip(
+        features.index.tolist(),
+        clusters.tolist(),
+        status,
+        features["recency"].tolist(),
+        features["frequency"].tolist(),
+        features["monetary"].tolist(),
+        aggregates["last_purchase"].tolist(),
+        [saved["version"]] * len(features)
+    ))
+
+
+def score(saved: dict, since, itersize: int) -> int:
+    """
+    Stream the aggregates of the customers with a purchase since 'since'
+    and store their segment, batch by batch, each batch in its own
+    transaction.
+    Return the number of customers scored.
+    """
+    scored = 0
+    batches = database.fetch_batches(
+        rfm.create_changed_aggregates_query(),
+        {"since": since},
+        itersize=itersize
+    )
+    for batch in batches:
+        rows = score_batch(saved, batch)
+        with database.get_connection() as connection:
+            cursor = connection.cursor()
+            execute_values(
+                cursor, create_upsert_query(), rows, page_size=10_000
+            )
+            connection.commit()
+            cursor.close()
+        scored += len(rows)
+        print(f"{scored:_} customers scored")
+    return scored
+
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Assign the new and changed customers to the clusters "
+                    "of the saved model."
+    )
+    parser.add_argument(
+        "--model",
+        default=clustering.MODEL_PATH,
+        metavar="PATH",
+        help="model saved by Clustering.py --save-model "
+             "(default: %(default)s)"
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="score all the customers instead of only the ones with a "
+             "purchase since the last run"
+    )
+    parser.add_argument(
+        "--itersize",
+        type=int,
+        default=database.STREAM_ITERSIZE,
+        help="number of customers per batch (default: %(default)s)"
+    )
+    arguments = parser.parse_args()
+    if arguments.itersize < 1:
+        parser.error("--itersize must be at least 1")
+    return arguments
+
+
+def main():
+
+    arguments = parse_arguments()
+
+    saved = clustering.load_model(arguments.model)
+    print(
+        f"Model {saved['version']} fitted on the purchases until "
+        f"{saved['watermark']}"
+    )
+
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(create_table_query())
+        connection.commit()
+        cursor.close()
+
+    since = get_since(saved["version"], arguments.all)
+    print(f"Scoring the customers with a purchase since {since}")
+
+    start = time.perf_counter()
+    scored = score(saved, since, arguments.itersize)
+    print(
+        f"{scored:_} customers scored in {time.perf_counter() - start:.3f}s"
+    )
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as error:
+        print("Error:", error)